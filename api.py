@@ -0,0 +1,220 @@
+"""
+JSON API for kiosks and the mobile client, mounted at /api/v1 (and /api as
+an alias for the latest version).
+
+Every GET carries an ETag built from the catalog version, which changes with
+any borrow, return or import. A poll that sends the ETag back in
+If-None-Match gets 304 Not Modified after reading only that version number,
+without running the catalog query. Authentication is the same session
+cookie the HTML pages use.
+"""
+from functools import wraps
+
+from flask import Blueprint, current_app, jsonify, request, session
+
+from models import db, Book, Hold, HoldQueue, Loan
+from loans import borrow_book, return_book, process_batch, place_hold, cancel_hold
+from catalog import Cursor
+from cache import catalog_version, get_catalog_cache
+from principal import loan_changed
+from replicas import replica_reads
+from suggest import get_suggest_index
+
+api = Blueprint('api', __name__)
+
+
+def book_json(book):
+    return {'id': book.id, 'title': book.title, 'author': book.author,
+            'available': book.available}
+
+
+def error(message, status):
+    return jsonify(error=message), status
+
+
+def login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if 'user_id' not in session:
+            return error('login required', 401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def conditional(per_user=False):
+    """
+    Answer 304 when the client already has the current version; otherwise
+    run the view and tag its response. The ETag is the catalog version (and
+    the user id for per-user resources), so checking it costs no other query.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with replica_reads():
+                etag = f'v{catalog_version()}'
+            if per_user:
+                etag += f'-u{session["user_id"]}'
+            if etag in request.if_none_match:
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
+
+
+@api.get('/books')
+@login_required
+@conditional()
+def books():
+    q = request.args.get('q', '').strip()
+    cursor = Cursor(request.args.get('after', type=int), request.args.get('rank', type=float))
+    limit = request.args.get('limit', current_app.config['BOOKS_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['BOOKS_MAX_PAGE_SIZE']))
+    with replica_reads():
+        page = get_catalog_cache().page(q, cursor, limit)
+    next_cursor = page.next_cursor._asdict() if page.next_cursor else None
+    return jsonify(books=[book_json(book) for book in page.books], next=next_cursor)
+
+
+@api.get('/books/<int:book_id>')
+@login_required
+@conditional()
+def book(book_id):
+    with replica_reads():
+        found = db.session.get(Book, book_id)
+    if found is None:
+        return error('no such book', 404)
+    return jsonify(book_json(found))
+
+
+@api.get('/books/availability')
+@login_required
+@conditional()
+def availability():
+    """{book_id, available} for ?ids=1,2,3, the same records /events pushes"""
+    try:
+        ids = {int(part) for part in request.args.get('ids', '').split(',') if part}
+    except ValueError:
+        return error('ids must be comma-separated integers', 400)
+    if len(ids) > current_app.config['BOOKS_MAX_PAGE_SIZE']:
+        return error('too many ids', 400)
+    with replica_reads():
+        rows = db.session.execute(
+            db.select(Book.id, Book.available).where(Book.id.in_(ids)).order_by(Book.id)
+        ).all() if ids else []
+    return jsonify(books=[{'book_id': book_id, 'available': available}
+                          for book_id, available in rows])
+
+
+@api.get('/me/loans')
+@login_required
+@conditional(per_user=True)
+def my_loans():
+    with replica_reads():
+        rows = db.session.execute(
+            db.select(Book, Loan.borrowed_at, Loan.due_at, Loan.fine_cents)
+            .join(Loan, Loan.book_id == Book.id)
+            .where(Loan.user_id == session['user_id'], Loan.returned_at.is_(None))
+            .order_by(Loan.borrowed_at)
+        ).all()
+    return jsonify(loans=[dict(book_json(book), borrowed_at=borrowed_at.isoformat(),
+                               due_at=due_at and due_at.isoformat(), fine_cents=fine_cents)
+                          for book, borrowed_at, due_at, fine_cents in rows])
+
+
+@api.get('/me/holds')
+@login_required
+@conditional(per_user=True)
+def my_holds():
+    with replica_reads():
+        rows = db.session.execute(
+            db.select(Book, Hold.ticket - HoldQueue.served, Hold.queued_at)
+            .join(Hold, Hold.book_id == Book.id)
+            .join(HoldQueue, HoldQueue.book_id == Book.id)
+            .where(Hold.user_id == session['user_id'])
+            .order_by(Hold.queued_at)
+        ).all()
+    return jsonify(holds=[dict(book_json(book), position=position, queued_at=queued_at.isoformat())
+                          for book, position, queued_at in rows])
+
+
+@api.get('/suggest')
+@login_required
+def suggest():
+    limit = request.args.get('limit', type=int)
+    with replica_reads():
+        tokens = get_suggest_index().suggest(request.args.get('prefix', ''), limit)
+    return jsonify(suggestions=tokens)
+
+
+@api.post('/books/<int:book_id>/borrow')
+@login_required
+def borrow_loan(book_id):
+    if not borrow_book(session['user_id'], book_id):
+        return error('book is not available', 409)
+    loan_changed(borrowed=[book_id])
+    return jsonify(book_json(db.session.get(Book, book_id)))
+
+
+@api.post('/books/<int:book_id>/return')
+@login_required
+def return_loan(book_id):
+    if not return_book(session['user_id'], book_id):
+        return error('you do not have this book', 409)
+    loan_changed(returned=[book_id])
+    return jsonify(book_json(db.session.get(Book, book_id)))
+
+
+@api.post('/books/<int:book_id>/hold')
+@login_required
+def hold(book_id):
+    result, position = place_hold(session['user_id'], book_id)
+    if result == 'not-found':
+        return error('no such book', 404)
+    if position is None:
+        return error(f'cannot hold: {result}', 409)
+    if result == 'queued':
+        loan_changed(holds={book_id: position})
+    return jsonify(book_id=book_id, position=position)
+
+
+@api.delete('/books/<int:book_id>/hold')
+@login_required
+def cancel(book_id):
+    if not cancel_hold(session['user_id'], book_id):
+        return error('you have no hold on this book', 404)
+    loan_changed(holds={book_id: None})
+    return '', 204
+
+
+@api.post('/loans/batch')
+@login_required
+def batch():
+    """Body: {"items": [{"book_id": 1, "action": "borrow"}, ...]}, applied in one transaction"""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('items'), list):
+        return error('items must be a list of {book_id, action}', 400)
+    try:
+        items = [(int(item['book_id']), item.get('action', 'borrow'))
+                 for item in payload['items']]
+    except (KeyError, TypeError, ValueError):
+        return error('items must be a list of {book_id, action}', 400)
+    if not items or any(action not in ('borrow', 'return') for _, action in items):
+        return error('items must be a list of {book_id, action}', 400)
+
+    results = process_batch(session['user_id'], items)
+    loan_changed(borrowed=[b for b, _, result in results if result == 'borrowed'],
+                 returned=[b for b, _, result in results if result == 'returned'])
+    return jsonify(results=[{'book_id': book_id, 'action': action, 'result': result}
+                            for book_id, action, result in results])
+
+
+def init_api(app):
+    app.register_blueprint(api, url_prefix='/api/v1')
+    app.register_blueprint(api, url_prefix='/api', name='api_latest')
@@ -1,127 +1,270 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+import threading
+
+from flask import (Blueprint, Flask, Response, current_app, render_template, stream_template,
+                   request, redirect, url_for, session, flash)
 from models import db, User, Book
-import os
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
-    'SQLALCHEMY_DATABASE_URI',
-    'sqlite:///library.db'  #本地开发默认 
-)
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db.init_app(app)
-
-with app.app_context():
-    db.create_all()
-    if Book.query.count() == 0:
-        books = [
-            Book(title='The Great Gatsby', author='F. Scott Fitzgerald'),
-            Book(title='1984', author='George Orwell'),
-            Book(title='To Kill a Mockingbird', author='Harper Lee')
-        ]
-        db.session.add_all(books)
-        db.session.commit()
-
-@app.route('/')
+from loans import borrow_book, return_book, process_batch, place_hold, cancel_hold
+from principal import current_loan_ids, current_holds, loan_changed, forget_principal
+from catalog import Cursor, iter_catalog
+from cache import init_catalog_cache, get_catalog_cache
+from commands import register_commands, init_db
+from metrics import init_metrics
+from sqlite_mode import init_sqlite
+from replicas import init_replicas, replica_reads
+from api import init_api
+from events import init_events, get_event_bus, sse_stream
+from stats import most_borrowed, top_authors, recent_days
+from passwords import (HashingBusy, init_passwords, hash_password, verify_password,
+                       upgrade_password)
+from users import UserExists, create_user
+from templating import init_templates
+from ratelimit import RateLimited, init_ratelimit, check_rate_limit
+from config import Config
+
+bp = Blueprint('library', __name__)
+
+
+def create_app(config=None):
+    """
+    Build the application. Nothing here talks to the database, so importing
+    the app (gunicorn --preload, tests, tooling) costs no round-trip.
+    """
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
+    init_replicas(app)
+    init_sqlite(app)
+    register_commands(app)
+    init_catalog_cache(app)
+    init_templates(app)
+    init_events(app)
+    init_metrics(app)
+    init_passwords(app)
+    init_ratelimit(app)
+    app.register_blueprint(bp)
+    init_api(app)
+    if app.config['AUTO_INIT_DB']:
+        init_db_on_first_request(app)
+    return app
+
+
+def init_db_on_first_request(app):
+    """Create the schema and seed books lazily, once per process"""
+    state = {'done': False}
+    lock = threading.Lock()
+
+    @app.before_request
+    def ensure_db():
+        if state['done']:
+            return
+        with lock:
+            if not state['done']:
+                init_db(seed=True)
+                state['done'] = True
+
+
+def too_many_attempts(template, limited):
+    flash(f'Too many attempts, please try again in {limited.retry_after} seconds.')
+    return render_template(template), 429, {'Retry-After': str(limited.retry_after)}
+
+
+@bp.route('/')
 def home():
-    return redirect(url_for('login'))
+    return redirect(url_for('library.login'))
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         user_id = request.form['user_id']
         name = request.form['name']
         email = request.form['email']
         password = request.form['password']
+        try:
+            check_rate_limit('register', email)
+        except RateLimited as limited:
+            return too_many_attempts('register.html', limited)
     
-        if User.query.filter_by(user_id = user_id).first() or User.query.filter_by( email=email).first():
+        try:
+            hashed = hash_password(password)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('register.html'), 503
+        try:
+            create_user(user_id, name, email, hashed)
+        except UserExists:
             flash('User ID or email already existd!')
-            return redirect(url_for('register'))
-    
-        new_user = User(user_id=user_id, name=name, email=email, password = password)
-        db.session.add(new_user)
-        db.session.commit()
+            return redirect(url_for('library.register'))
     
         flash('Registration Successful! Please log in.')
-        return redirect(url_for('login'))
+        return redirect(url_for('library.login'))
     return render_template('register.html') 
 
-@app.route('/login', methods=['GET','POST'])
+@bp.route('/login', methods=['GET','POST'])
 def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
-        user = User.query.filter_by(email=email).first()
-        
-        if user and user.password == password:
+        try:
+            check_rate_limit('login', email)
+        except RateLimited as limited:
+            return too_many_attempts('login.html', limited)
+        with replica_reads():
+            user = User.query.filter_by(email=email).first()
+        try:
+            valid = verify_password(user.password if user else None, password)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('login.html'), 503
+
+        if valid:
+            upgrade_password(user, password)
+            forget_principal()
             session['user_id'] = user.id
             flash('Login successful!')
-            return redirect(url_for('books'))
+            return redirect(url_for('library.books'))
         
         else:
             flash('Invalid email or password!')
     
     return render_template('login.html')
     
-@app.route('/books', methods=['GET', 'POST'])
+@bp.route('/books', methods=['GET', 'POST'])
 def books():
     if 'user_id' not in session:# WHAT IS A SESSION ? 
        flash('Please log in to access books.') 
-       return redirect(url_for('login'))
+       return redirect(url_for('library.login'))
        
-    user = User.query.get(session['user_id'])
+    user_id = session['user_id']
 
     # Handle POST actions: borrow or return
-    if request.method == 'POST':
+    if request.method == 'POST' and 'batch' in request.form:
+        # A whole stack from the checkboxes: one transaction, one render
+        action = request.form.get('action', 'borrow')
+        items = [(int(book_id), action) for book_id in request.form.getlist('book_ids')]
+        if not items:
+            flash('No books selected')
+        else:
+            results = process_batch(user_id, items)
+            done = [book_id for book_id, _, result in results
+                    if result in ('borrowed', 'returned')]
+            if done:
+                if action == 'return':
+                    loan_changed(returned=done)
+                else:
+                    loan_changed(borrowed=done)
+            verb = 'Returned' if action == 'return' else 'Borrowed'
+            message = f'{verb} {len(done)} of {len(results)} books'
+            skipped = len(results) - len(done)
+            flash(f'{message} ({skipped} not available)' if skipped else message)
+
+    elif request.method == 'POST' and request.form.get('action') in ('hold', 'cancel-hold'):
+        # Queue for a book that is out instead of retrying Borrow
+        book_id = int(request.form['book_id'])
+        if request.form['action'] == 'cancel-hold':
+            if cancel_hold(user_id, book_id):
+                loan_changed(holds={book_id: None})
+                flash('Hold cancelled')
+        else:
+            result, position = place_hold(user_id, book_id)
+            if result == 'queued':
+                loan_changed(holds={book_id: position})
+            if position:
+                flash(f'You are number {position} in the queue')
+            elif result == 'available':
+                flash('That book is available now, borrow it instead')
+            else:
+                flash('Book is not available!')
+
+    elif request.method == 'POST':
         book_id = int(request.form['book_id'])
         action = request.form.get('action', 'borrow')
-        book = Book.query.get(book_id)
+        # The conditional UPDATE is the first statement of the transaction, so
+        # no read snapshot is held while we wait for the write lock.
+        if action == 'return':
+            # Only allow return if user has borrowed this book
+            done = return_book(user_id, book_id)
+        else:
+            done = borrow_book(user_id, book_id)
+
+        if done:
+            # Keep the loans cached in the session in step with the write
+            if action == 'return':
+                loan_changed(returned=[book_id])
+            else:
+                loan_changed(borrowed=[book_id])
+        book = db.session.get(Book, book_id) if done else None
         if not book:
             flash('Book is not available!')  # keep message consistent
         elif action == 'return':
-            # Only allow return if user has borrowed this book
-            borrowed_ids = [int(bid) for bid in user.borrowed_books.split(',') if bid]
-            if book_id in borrowed_ids:
-                # mark available and remove from user's list
-                book.available = True
-                borrowed_ids.remove(book_id)
-                user.borrowed_books = ','.join(str(b) for b in borrowed_ids)
-                db.session.commit()
-                flash(f'Returned {book.title}')
-            else:
-                flash('Book is not available!')
+            flash(f'Returned {book.title}')
         else:
-            if book and book.available:
-                book.available = False
-                if user.borrowed_books:
-                    user.borrowed_books += f",{book_id}"
-                else:
-                    user.borrowed_books = str(book_id)
-                db.session.commit()
-                flash(f'You borrowed {book.title}')
-            else:
-                flash('Book is not available!')
+            flash(f'You borrowed {book.title}')
 
     # Search/filter on GET (and after POST redirectless render)
     q = request.args.get('q', '').strip()
-    query = Book.query
-    if q:
-        like = f"%{q}%"
-        query = query.filter((Book.title.ilike(like)) | (Book.author.ilike(like)))
-    all_books = query.all()
-
-    borrowed_ids = [int(bid) for bid in user.borrowed_books.split(',') if bid]
-    return render_template('books.html', books=all_books, borrowed_ids=borrowed_ids)
+    cursor = Cursor(request.args.get('after', type=int), request.args.get('rank', type=float))
+
+    # Reads go to a replica unless this request (or a recent one) wrote
+    with replica_reads():
+        borrowed_ids = current_loan_ids()
+        holds = current_holds()
+
+    if request.args.get('stream'):
+        # Rows are pulled from the database as the response is written
+        def books_iter():
+            with replica_reads():
+                yield from iter_catalog(q, cursor, current_app.config['BOOKS_STREAM_CHUNK'])
+
+        return stream_template('books.html', books=books_iter(), borrowed_ids=borrowed_ids,
+                               holds=holds, next_url=None)
+
+    limit = request.args.get('limit', current_app.config['BOOKS_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['BOOKS_MAX_PAGE_SIZE']))
+    with replica_reads():
+        page = get_catalog_cache().page(q, cursor, limit)
+
+    next_url = None
+    if page.next_cursor:
+        next_url = url_for('library.books', q=q or None, after=page.next_cursor.after,
+                           rank=page.next_cursor.rank, limit=request.args.get('limit'))
+    return render_template('books.html', books=page.books, borrowed_ids=borrowed_ids,
+                           holds=holds, next_url=next_url)
     
-@app.route('/logout')
+@bp.route('/events')
+def events():
+    """Server-sent {book_id, available} changes for books.html"""
+    if 'user_id' not in session:
+        return Response(status=401)
+    if not current_app.config['EVENTS_STREAM']:
+        return Response(status=404)  # books.html polls the API instead
+    stream = sse_stream(get_event_bus(), current_app.config['EVENTS_HEARTBEAT'],
+                        current_app.config['EVENTS_MAX_AGE'])
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/popular')
+def popular():
+    """Most borrowed books and authors, read from the folded counters"""
+    if 'user_id' not in session:
+        flash('Please log in to access books.')
+        return redirect(url_for('library.login'))
+    with replica_reads():
+        return render_template('popular.html', books=most_borrowed(), authors=top_authors(),
+                               days=recent_days())
+
+@bp.route('/logout')
 def logout():
     session.pop('user_id', None)
+    forget_principal()
     flash('Logged out successfully!')
-    return redirect(url_for('login'))
+    return redirect(url_for('library.login'))
         
         
+app = create_app()
+
 if __name__ == '__main__':
     app.run(debug=True)
     
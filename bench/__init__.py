@@ -0,0 +1,4 @@
+"""
+Benchmarks for the library app. Run modules from the repository root, e.g.
+`python -m bench.bench_search`.
+"""
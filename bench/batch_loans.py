@@ -0,0 +1,81 @@
+"""
+Checking out a stack of books: N single POSTs versus one batch request.
+
+    python -m bench.batch_loans --stack 10 --repeat 20
+
+Uses the Flask test client against a SQLite file so only the application and
+database work is measured. Each round borrows the stack and returns it again,
+either one POST /books per book (each committing and re-rendering the
+catalog), as one POST /books with all the checkboxes ticked, or as one JSON
+request to /api/v1/loans/batch.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from bench.common import emit, git_revision, make_app, summarize
+from bench.datagen import build_dataset
+from models import db, User
+
+
+def single_posts(client, book_ids):
+    for action in ('borrow', 'return'):
+        for book_id in book_ids:
+            client.post('/books', data={'book_id': book_id, 'action': action})
+
+
+def batch_form(client, book_ids):
+    for action in ('borrow', 'return'):
+        client.post('/books', data={'batch': '1', 'book_ids': book_ids, 'action': action})
+
+
+def batch_json(client, book_ids):
+    for action in ('borrow', 'return'):
+        client.post('/api/v1/loans/batch',
+                    json={'items': [{'book_id': b, 'action': action} for b in book_ids]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--books', type=int, default=10_000)
+    parser.add_argument('--stack', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), f'library-bench-batch-{args.books}.db')
+    app = make_app(f'sqlite:///{path}')
+    with app.app_context():
+        build_dataset(args.books, 1)
+        user_id = db.session.scalar(db.select(User.id))
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    book_ids = list(range(1, args.stack + 1))
+
+    scenarios = {}
+    for name, fn in (('single_posts', single_posts), ('batch_form', batch_form),
+                     ('batch_json', batch_json)):
+        fn(client, book_ids)  # warm up
+        samples = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            fn(client, book_ids)
+            samples.append(time.perf_counter() - start)
+        scenarios[name] = summarize(samples)
+
+    baseline = scenarios['single_posts']['mean_ms']
+    emit({
+        'benchmark': 'batch_loans',
+        'revision': git_revision(),
+        'params': {'books': args.books, 'stack': args.stack, 'repeat': args.repeat},
+        'scenarios': scenarios,
+        'speedup': {name: round(baseline / max(s['mean_ms'], 1e-9), 2)
+                    for name, s in scenarios.items() if name != 'single_posts'},
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Per-attempt cost of the rate limiter's stores, alone and with other processes.
+
+    python -m bench.bench_ratelimit
+    python -m bench.bench_ratelimit --stores mmap --processes 4 --hits 50000
+
+Each process times --hits store hits spread over --keys client addresses,
+with a limit high enough that every hit is allowed (the happy path a real
+login pays). With --processes above one they share the store, as gunicorn
+workers do, so the mmap and SQLite numbers include waiting for the lock.
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from bench.common import emit, git_revision, summarize
+from ratelimit import open_store, parse_limit
+
+
+def hammer(uri, hits, keys, results):
+    store = open_store(uri)
+    limit = parse_limit(f'{hits * 1000}/minute')
+    samples = []
+    for n in range(hits):
+        key = f'login-ip:10.0.{n % keys // 256}.{n % 256}'
+        start = time.perf_counter()
+        store.hit(key, time.time(), *limit)
+        samples.append(time.perf_counter() - start)
+    results.put(samples)
+
+
+def run_store(uri, args):
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=hammer, args=(uri, args.hits, args.keys, results))
+             for _ in range(args.processes)]
+    for proc in procs:
+        proc.start()
+    samples = [s for _ in procs for s in results.get()]
+    for proc in procs:
+        proc.join()
+    return {**summarize(samples), 'mean_us': round(statistics.fmean(samples) * 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--stores', nargs='+', default=['memory', 'mmap', 'sqlite'])
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--hits', type=int, default=20_000)
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='library-bench-ratelimit-')
+    uris = {'memory': 'memory://', 'mmap': f'mmap://{os.path.join(directory, "limits")}',
+            'sqlite': f'sqlite://{os.path.join(directory, "limits.db")}'}
+    emit({
+        'benchmark': 'ratelimit',
+        'revision': git_revision(),
+        'params': {'processes': args.processes, 'hits': args.hits, 'keys': args.keys},
+        'scenarios': {store: run_store(uris[store], args) for store in args.stores},
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Render time of books.html with and without the row cache, and template compile time.
+
+    python -m bench.bench_render                  # 10k rows
+    python -m bench.bench_render --rows 50000 --repeat 10
+
+No database or HTTP is involved: --rows synthetic catalog rows (a third of
+them out on loan) are rendered in a test request context, as the streaming
+?all=1 view renders the whole catalog. Scenarios:
+
+    uncached     CATALOG_ROW_CACHE_SIZE=0, every row rendered by the macro
+    cold         row cache enabled but empty (first page view after a restart)
+    warm         the same user again
+    other_user   a different user with other loans and holds on a warm cache
+
+compile_ms times loading every template into a fresh environment with no
+bytecode cache, and then from a bytecode cache directory filled beforehand.
+"""
+import argparse
+import random
+import shutil
+import tempfile
+
+from flask import render_template
+from jinja2 import Environment, FileSystemBytecodeCache
+
+from bench.common import emit, git_revision, make_app, summarize, timed
+from bench.datagen import iter_books
+from cache import BookRow
+
+
+def catalog(size, seed=3):
+    rng = random.Random(seed)
+    return [BookRow(n, book['title'], book['author'], rng.random() > 0.33)
+            for n, book in enumerate(iter_books(size), start=1)]
+
+
+def viewer(rows, seed):
+    """(borrowed ids, holds) for a user with a few loans and holds among the books that are out"""
+    rng = random.Random(seed)
+    out = [row.id for row in rows if not row.available]
+    picked = rng.sample(out, min(len(out), 30))
+    return set(picked[:20]), {book_id: rng.randint(1, 5) for book_id in picked[20:]}
+
+
+def render_ms(app, rows, user, repeat):
+    borrowed_ids, holds = user
+    with app.test_request_context('/books'):
+        _, samples = timed(lambda: render_template('books.html', books=rows,
+                                                   borrowed_ids=borrowed_ids, holds=holds,
+                                                   next_url=None), repeat)
+    return samples
+
+
+def compile_ms(app, repeat):
+    directory = tempfile.mkdtemp(prefix='library-bench-jinja-')
+    try:
+        def load_all(bytecode_cache):
+            env = Environment(loader=app.jinja_env.loader, bytecode_cache=bytecode_cache)
+            for name in env.list_templates(extensions=['html']):
+                env.get_template(name)
+
+        _, plain = timed(lambda: load_all(None), repeat)
+        load_all(FileSystemBytecodeCache(directory))
+        _, cached = timed(lambda: load_all(FileSystemBytecodeCache(directory)), repeat)
+    finally:
+        shutil.rmtree(directory)
+    return {'no_bytecode_cache': summarize(plain), 'bytecode_cache': summarize(cached)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=10_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    rows = catalog(args.rows)
+    alice, bob = viewer(rows, 1), viewer(rows, 2)
+    uncached_app = make_app('sqlite://', CATALOG_ROW_CACHE_SIZE=0)
+    app = make_app('sqlite://', CATALOG_ROW_CACHE_SIZE=2 * args.rows)
+
+    # Compile books.html and the row macro first so only rendering is timed
+    render_ms(uncached_app, rows[:1], alice, 1)
+    render_ms(app, rows[:1], alice, 1)
+    app.extensions['catalog_cache'].rows.clear()
+
+    scenarios = {
+        'uncached': summarize(render_ms(uncached_app, rows, alice, args.repeat)),
+        'cold': summarize(render_ms(app, rows, alice, 1)),
+        'warm': summarize(render_ms(app, rows, alice, args.repeat)),
+        'other_user': summarize(render_ms(app, rows, bob, args.repeat)),
+    }
+    emit({
+        'benchmark': 'bench_render',
+        'revision': git_revision(),
+        'params': {'rows': args.rows, 'repeat': args.repeat},
+        'scenarios': scenarios,
+        'speedup': round(scenarios['uncached']['p50_ms'] / scenarios['warm']['p50_ms'], 1),
+        'row_cache_entries': len(app.extensions['catalog_cache'].rows),
+        'compile_ms': compile_ms(app, args.repeat),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Compare the /books search backends at several catalog sizes.
+
+    python -m bench.bench_search                       # 10k, 100k, 1M on SQLite
+    python -m bench.bench_search --sizes 10000 --repeat 20
+    python -m bench.bench_search --mysql-uri mysql+pymysql://root:pw@127.0.0.1:3306/bench
+
+Each size gets its own SQLite file under --workdir (reused between runs).
+With --mysql-uri the same catalog is loaded into MySQL and the LIKE and
+FULLTEXT backends are measured there too.
+"""
+import argparse
+import os
+import tempfile
+
+from models import db, Book
+from search import BACKENDS, tokenize
+from bench.common import make_app, timed, summarize, emit
+from bench.datagen import load_books, vocabulary
+
+
+def sample_queries():
+    words = vocabulary()
+    return {
+        'common_word': words[0],
+        'rare_word': words[-1],
+        'prefix': words[len(words) // 2][:4],
+        'two_words': f'{words[1]} {words[2]}',
+    }
+
+
+def prepare(app, size):
+    with app.app_context():
+        db.create_all()
+        existing = db.session.scalar(db.select(db.func.count(Book.id)))
+        if existing != size:
+            db.drop_all()
+            db.create_all()
+            load_books(size)
+
+
+def measure(app, backends, queries, repeat):
+    results = {}
+    with app.app_context():
+        for name in backends:
+            backend = BACKENDS[name]()
+            per_query = {}
+            for label, q in queries.items():
+                if not tokenize(q):
+                    continue
+                # Cap the page like the UI does so we time the search, not the fetch
+                stmt = backend.search(q).limit(50)
+                rows, samples = timed(lambda: db.session.scalars(stmt).all(), repeat)
+                per_query[label] = {'q': q, 'rows': len(rows), **summarize(samples)}
+            results[name] = per_query
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'library-bench'))
+    parser.add_argument('--mysql-uri', help='also benchmark LIKE and FULLTEXT on this MySQL database')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    queries = sample_queries()
+    report = {'benchmark': 'search', 'repeat': args.repeat, 'sizes': {}}
+
+    for size in args.sizes:
+        entry = {}
+        app = make_app(f"sqlite:///{os.path.join(args.workdir, f'search-{size}.db')}")
+        prepare(app, size)
+        entry['sqlite'] = measure(app, ['like', 'fts5'], queries, args.repeat)
+
+        if args.mysql_uri:
+            app = make_app(args.mysql_uri)
+            prepare(app, size)
+            entry['mysql'] = measure(app, ['like', 'fulltext'], queries, args.repeat)
+        report['sizes'][str(size)] = entry
+
+    emit(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Build the typeahead prefix index over a synthetic catalog and time lookups.
+
+    python -m bench.bench_suggest                     # 10k, 100k, 1M titles
+    python -m bench.bench_suggest --sizes 100000 --queries 5000
+
+No database is involved: rows come straight from bench.datagen, so the
+numbers are the index build time (rows are fed in chunks, as the worker's
+catch-up does, and generating them is not counted), the size of the index
+structures including the token strings, per-lookup latency for one-,
+two-, three- and four-letter prefixes, and catch_up: adding one more book
+with a new token to the built index, as a worker does after a single write.
+"""
+import argparse
+import itertools
+import random
+import sys
+import time
+
+from suggest import PrefixIndex
+from bench.common import emit, git_revision, summarize
+from bench.datagen import iter_books, vocabulary
+
+
+def build(size, chunk_size=10_000):
+    rows = ((n, book['title'], book['author'])
+            for n, book in enumerate(iter_books(size), start=1))
+    index = PrefixIndex()
+    seconds = 0.0
+    while chunk := list(itertools.islice(rows, chunk_size)):
+        start = time.perf_counter()
+        index.add_books(chunk)
+        seconds += time.perf_counter() - start
+    return index, seconds
+
+
+def catch_up(index, size, repeat=20):
+    samples = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        index.add_books([(size + n + 1, f'Zyxq{n} Novel', 'New Author')])
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def index_bytes(index):
+    tokens, counts, top = index._state
+    return (sys.getsizeof(tokens) + sum(sys.getsizeof(t) for t in tokens)
+            + counts.buffer_info()[1] * counts.itemsize
+            + sys.getsizeof(top) + sum(sys.getsizeof(ids) for ids in top.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    words = vocabulary()
+    results = []
+    for size in args.sizes:
+        index, seconds = build(size)
+        lookups = {}
+        for length in (1, 2, 3, 4):
+            prefixes = [rng.choice(words)[:length] for _ in range(args.queries)]
+            samples = []
+            for prefix in prefixes:
+                start = time.perf_counter()
+                index.suggest(prefix)
+                samples.append(time.perf_counter() - start)
+            lookups[f'prefix_{length}'] = summarize(samples)
+        results.append({'size': size, 'tokens': len(index), 'build_s': round(seconds, 2),
+                        'memory_mb': round(index_bytes(index) / 2**20, 2), 'lookups': lookups,
+                        'catch_up': catch_up(index, size)})
+
+    emit({'benchmark': 'bench_suggest', 'revision': git_revision(),
+          'params': {'queries': args.queries}, 'results': results}, args.output)
+
+
+if __name__ == '__main__':
+    main()
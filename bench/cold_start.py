@@ -0,0 +1,49 @@
+"""
+Measure worker cold start: how long a fresh interpreter takes to import the
+app module and build the WSGI app, which is what every gunicorn worker pays
+when the app isn't preloaded.
+
+    python -m bench.cold_start --runs 10 --budget-ms 800
+
+Exits with status 1 when the median import time is over budget. No database
+is contacted; the URI points at a directory that doesn't exist to prove it.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from bench.common import summarize, emit
+
+PROBE = (
+    'import time; start = time.perf_counter(); import app; '
+    'print(time.perf_counter() - start)'
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=800)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    unreachable = os.path.join(tempfile.gettempdir(), 'no-such-dir', 'library.db')
+    env = {**os.environ, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{unreachable}'}
+
+    samples = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, '-c', PROBE], cwd=root, env=env,
+                             capture_output=True, text=True, check=True)
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+
+    report = {'benchmark': 'cold_start', 'budget_ms': args.budget_ms, 'import': summarize(samples)}
+    report['within_budget'] = report['import']['p50_ms'] <= args.budget_ms
+    emit(report, args.output)
+    sys.exit(0 if report['within_budget'] else 1)
+
+
+if __name__ == '__main__':
+    main()
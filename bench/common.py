@@ -0,0 +1,63 @@
+"""
+Shared helpers for the benchmark scripts
+"""
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from app import create_app
+
+
+def make_app(database_uri, **config):
+    """An app bound to the benchmark database that never seeds it"""
+    return create_app({'SQLALCHEMY_DATABASE_URI': database_uri, 'AUTO_INIT_DB': False, **config})
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def timed(fn, repeat):
+    """Call fn() `repeat` times; return (last result, list of seconds)"""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return result, samples
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds"""
+    return {
+        'n': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3) if samples else 0.0,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+def emit(report, path=None):
+    """Write the report as JSON to `path`, or stdout"""
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
@@ -0,0 +1,64 @@
+"""
+Compare two load-test reports and flag regressions.
+
+    python -m bench.compare baseline.json candidate.json --threshold 10
+
+Prints one line per scenario with the change in throughput and p95/p99
+latency, and exits with status 1 if any of them got worse by more than
+--threshold percent. Reports must come from the same parameters.
+"""
+import argparse
+import json
+import sys
+
+CHECKS = (('throughput_rps', 'higher'), ('p95_ms', 'lower'), ('p99_ms', 'lower'))
+
+
+def change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+
+def compare(baseline, candidate, threshold):
+    regressions = []
+    lines = []
+    for scenario, old in sorted(baseline['scenarios'].items()):
+        new = candidate['scenarios'].get(scenario)
+        if new is None:
+            continue
+        parts = []
+        for metric, better in CHECKS:
+            delta = change(old[metric], new[metric])
+            worse = -delta if better == 'higher' else delta
+            flag = ''
+            if worse > threshold:
+                flag = ' !'
+                regressions.append(f'{scenario}.{metric}')
+            parts.append(f'{metric} {old[metric]} -> {new[metric]} ({delta:+.1f}%){flag}')
+        lines.append(f'{scenario:>14}: ' + ', '.join(parts))
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    if baseline.get('params') != candidate.get('params'):
+        print('warning: reports were produced with different parameters', file=sys.stderr)
+    print(f"{baseline.get('revision')} -> {candidate.get('revision')}")
+    lines, regressions = compare(baseline, candidate, args.threshold)
+    print('\n'.join(lines))
+    if regressions:
+        print(f"Regressions over {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
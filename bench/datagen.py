@@ -0,0 +1,104 @@
+"""
+Deterministic synthetic catalogs and users for benchmarks.
+
+Titles and authors are built from a fixed pseudo-word vocabulary so that the
+same seed always produces the same catalog, which keeps numbers comparable
+between runs.
+
+    python -m bench.datagen --books 100000 --users 100000 --database-uri sqlite:////tmp/bench.db
+"""
+import argparse
+import random
+import time
+
+from models import db, Book, User
+from passwords import get_hasher, make_hash
+
+BENCH_PASSWORD = 'bench-password'
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ren', 'tor', 'vel', 'an', 'dra', 'su', 'bel',
+             'gor', 'nix', 'pa', 'qui', 'sha', 'tem', 'ul', 'wy', 'zen', 'or']
+
+
+def vocabulary(size=5000, seed=7):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def iter_books(count, seed=42):
+    """Yield `count` book dicts with Zipf-ish word frequencies"""
+    rng = random.Random(seed)
+    words = vocabulary()
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    surnames = words[::7]
+    for _ in range(count):
+        title = ' '.join(rng.choices(words, weights, k=rng.randint(2, 6))).title()
+        author = f'{rng.choice(words).title()} {rng.choice(surnames).title()}'
+        yield {'title': title, 'author': author, 'available': True}
+
+
+def iter_users(count, password_hash=None):
+    """Yield `count` user dicts; user n logs in as bench{n}@example.com"""
+    for n in range(count):
+        yield {'user_id': f'bench{n:07}', 'name': f'Bench User {n}',
+               'email': bench_email(n), 'password': password_hash or BENCH_PASSWORD}
+
+
+def bench_email(n):
+    return f'bench{n}@example.com'
+
+
+def bulk_insert(model, rows, batch_size=10000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            db.session.execute(db.insert(model), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(model), batch)
+    db.session.commit()
+
+
+def load_books(count, batch_size=10000, seed=42):
+    """Bulk-insert a synthetic catalog into the current app's database"""
+    bulk_insert(Book, iter_books(count, seed), batch_size)
+
+
+def load_users(count, batch_size=10000):
+    # One hash at the app's cost shared by every user: hashing each would
+    # dominate the load, and logins then measure a current-format hash
+    password_hash = make_hash(BENCH_PASSWORD, **get_hasher().params)
+    bulk_insert(User, iter_users(count, password_hash), batch_size)
+
+
+def build_dataset(books, users, seed=42):
+    """Recreate the schema and load a fresh synthetic dataset"""
+    db.drop_all()
+    db.create_all()
+    load_books(books, seed=seed)
+    load_users(users)
+
+
+def main():
+    from bench.common import make_app
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic benchmark dataset.')
+    parser.add_argument('--books', type=int, default=100_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database-uri', required=True)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with make_app(args.database_uri).app_context():
+        build_dataset(args.books, args.users, args.seed)
+    print(f'Loaded {args.books} books and {args.users} users '
+          f'in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
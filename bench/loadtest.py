@@ -0,0 +1,242 @@
+"""
+Concurrent load test of the core routes against a real server.
+
+    python -m bench.loadtest --books 100000 --users 100000 --concurrency 16 --duration 30
+    python -m bench.loadtest --database-uri mysql+pymysql://root:pw@127.0.0.1:3306/bench
+    python -m bench.loadtest --url http://127.0.0.1:5000 --skip-load   # already-running server
+
+Builds (or reuses) a synthetic dataset, starts gunicorn on it, and has
+--concurrency virtual users log in and then run a weighted mix of catalog
+listing, search and borrow/return for --duration seconds. Throughput and
+p50/p95/p99 latency per scenario are reported as JSON together with the git
+revision and every parameter, so reports can be diffed with bench.compare.
+
+Every virtual user logs in from 127.0.0.1, so the server is started with the
+login rate limiter off. Against --url it may still be on: 429 responses count
+as errors and are also reported per scenario as rate_limited.
+"""
+import argparse
+import http.client
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from bench.common import emit, git_revision, make_app, summarize
+from bench.datagen import BENCH_PASSWORD, bench_email, build_dataset, vocabulary
+from models import db, Book, User
+
+SCENARIOS = {'list': 50, 'search': 30, 'borrow_return': 15, 'login': 5}
+
+
+class Client:
+    """Keep-alive HTTP client that carries the session cookie"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        self.cookie = None
+        self.status = None
+
+    def request(self, method, path, form=None):
+        headers = {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        self.status = response.status
+        data = response.read()
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return response.status, data
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, n, base_url, deadline, book_ids, words, results, errors, limited):
+        super().__init__(daemon=True)
+        self.n = n
+        self.base_url = base_url
+        self.client = Client(base_url)
+        self.deadline = deadline
+        self.book_ids = book_ids
+        self.words = words
+        self.results = results
+        self.errors = errors
+        self.limited = limited
+        self.rng = random.Random(n)
+
+    def timed(self, scenario, fn):
+        start = time.perf_counter()
+        ok = fn()
+        elapsed = time.perf_counter() - start
+        self.results[scenario].append(elapsed)
+        if not ok:
+            self.errors[scenario] = self.errors.get(scenario, 0) + 1
+            if self.client.status == 429:
+                self.limited[scenario] = self.limited.get(scenario, 0) + 1
+
+    def login(self):
+        status, _ = self.client.request('POST', '/login', {'email': bench_email(self.n),
+                                                           'password': BENCH_PASSWORD})
+        return status == 302
+
+    def list_books(self):
+        status, _ = self.client.request('GET', '/books')
+        return status == 200
+
+    def search(self):
+        query = urlencode({'q': self.rng.choice(self.words)})
+        status, _ = self.client.request('GET', f'/books?{query}')
+        return status == 200
+
+    def borrow_return(self):
+        book_id = self.rng.choice(self.book_ids)
+        status, _ = self.client.request('POST', '/books', {'book_id': book_id, 'action': 'borrow'})
+        if status != 200:
+            return False
+        status, _ = self.client.request('POST', '/books', {'book_id': book_id, 'action': 'return'})
+        return status == 200
+
+    def run(self):
+        self.timed('login', self.login)
+        actions = {'list': self.list_books, 'search': self.search,
+                   'borrow_return': self.borrow_return, 'login': self.login}
+        names = list(SCENARIOS)
+        weights = [SCENARIOS[name] for name in names]
+        while time.monotonic() < self.deadline:
+            scenario = self.rng.choices(names, weights)[0]
+            try:
+                self.timed(scenario, actions[scenario])
+            except (OSError, http.client.HTTPException):
+                self.errors[scenario] = self.errors.get(scenario, 0) + 1
+                self.client = Client(self.base_url)
+                self.login()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(database_uri, workers, worker_class, port, **extra_env):
+    env = {
+        **os.environ,
+        'SQLALCHEMY_DATABASE_URI': database_uri,
+        'AUTO_INIT_DB': '0',
+        'GUNICORN_BIND': f'127.0.0.1:{port}',
+        'GUNICORN_WORKERS': str(workers),
+        'GUNICORN_WORKER_CLASS': worker_class,
+        'METRICS_DIR': tempfile.mkdtemp(prefix='library-bench-metrics-'),
+        # Every virtual user logs in from 127.0.0.1; the limiter would turn logins into 429s
+        'RATELIMIT_ENABLED': '0',
+        **extra_env,
+    }
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app']
+    server = subprocess.Popen(command, cwd=root, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'gunicorn exited: {server.stderr.read().decode()}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start within 30s')
+
+
+def run_load(base_url, concurrency, duration, book_ids, warmup):
+    words = vocabulary()[:200]
+    results = {name: [] for name in SCENARIOS}
+    errors, limited = {}, {}
+    if warmup:
+        run_load(base_url, concurrency, warmup, book_ids, 0)
+    deadline = time.monotonic() + duration
+    users = [VirtualUser(n, base_url, deadline, book_ids, words, results, errors, limited)
+             for n in range(concurrency)]
+    started = time.perf_counter()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.perf_counter() - started
+
+    scenarios = {}
+    total = 0
+    for name, samples in results.items():
+        total += len(samples)
+        scenarios[name] = {**summarize(samples), 'throughput_rps': round(len(samples) / elapsed, 1),
+                           'errors': errors.get(name, 0), 'rate_limited': limited.get(name, 0)}
+    return {'elapsed_s': round(elapsed, 2), 'total_rps': round(total / elapsed, 1),
+            'scenarios': scenarios}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--books', type=int, default=10_000)
+    parser.add_argument('--users', type=int, default=1_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database-uri',
+                        help='default: a SQLite file per dataset size under the temp dir')
+    parser.add_argument('--skip-load', action='store_true', help='reuse the existing dataset')
+    parser.add_argument('--url', help='benchmark this running server instead of starting one')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+    args.concurrency = min(args.concurrency, args.users)
+
+    database_uri = args.database_uri or 'sqlite:///' + os.path.join(
+        tempfile.gettempdir(), f'library-bench-{args.books}-{args.users}-{args.seed}.db')
+    app = make_app(database_uri)
+    with app.app_context():
+        if not args.skip_load:
+            build_dataset(args.books, args.users, args.seed)
+        book_ids = list(db.session.scalars(db.select(Book.id).limit(5000)))
+        users = db.session.scalar(db.select(db.func.count(User.id)))
+        db.engine.dispose()
+
+    server = None
+    base_url = args.url
+    if not base_url:
+        port = free_port()
+        server = start_server(database_uri, args.workers, args.worker_class, port)
+        base_url = f'http://127.0.0.1:{port}'
+    try:
+        result = run_load(base_url, args.concurrency, args.duration, book_ids, args.warmup)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    emit({
+        'benchmark': 'loadtest',
+        'revision': git_revision(),
+        'params': {'books': args.books, 'users': users, 'seed': args.seed,
+                   'database': database_uri.split(':', 1)[0],
+                   'workers': args.workers, 'worker_class': args.worker_class,
+                   'concurrency': args.concurrency, 'duration_s': args.duration,
+                   'mix': SCENARIOS},
+        **result,
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Login throughput and page latency at different scrypt costs.
+
+    python -m bench.login_cost --costs 12 13 14 15 --logins 8 --readers 4
+    python -m bench.login_cost --worker-class gevent --logins 32
+
+For each PASSWORD_SCRYPT_LN in --costs a SQLite file is loaded with users
+hashed at that cost and a fresh gunicorn server is started with it. --logins
+clients then log in as fast as they can while --readers clients fetch /books.
+Pick the largest cost whose login p99 is acceptable at the login rate you
+expect; `rejected` counts 503s from a full hashing queue, and books_p99_ms
+shows whether hashing starves ordinary pages.
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from bench.common import emit, git_revision, make_app, summarize
+from bench.datagen import BENCH_PASSWORD, bench_email, build_dataset
+from bench.loadtest import Client, free_port, start_server
+from bench.read_under_writes import client_loop, read
+from models import db
+
+
+def login_loop(base_url, n, deadline, samples, rejected, errors):
+    credentials = {'email': bench_email(n), 'password': BENCH_PASSWORD}
+    while time.monotonic() < deadline:
+        client = Client(base_url)
+        start = time.perf_counter()
+        try:
+            status, _ = client.request('POST', '/login', credentials)
+        except OSError:
+            status = None
+        samples.append(time.perf_counter() - start)
+        if status == 503:
+            rejected.append(n)
+        elif status != 302:  # success redirects to /books
+            errors.append(n)
+
+
+def run_cost(ln, args):
+    path = os.path.join(tempfile.gettempdir(), f'library-bench-login-{ln}.db')
+    database_uri = f'sqlite:///{path}'
+    app = make_app(database_uri, PASSWORD_SCRYPT_LN=ln)
+    with app.app_context():
+        build_dataset(args.books, args.logins + args.readers)
+        db.engine.dispose()
+
+    port = free_port()
+    extra = {'PASSWORD_SCRYPT_LN': str(ln), 'PASSWORD_HASH_WORKERS': str(args.hash_workers)}
+    server = start_server(database_uri, args.workers, args.worker_class, port, **extra)
+    base_url = f'http://127.0.0.1:{port}'
+    logins, rejected, login_errors, reads, read_errors = [], [], [], [], []
+    try:
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=login_loop,
+                                    args=(base_url, n, deadline, logins, rejected, login_errors))
+                   for n in range(args.logins)]
+        threads += [threading.Thread(target=client_loop,
+                                     args=(base_url, args.logins + n, deadline, reads,
+                                           read_errors, read))
+                    for n in range(args.readers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = {'login': {**summarize(logins),
+                        'throughput_rps': round((len(logins) - len(rejected)) / elapsed, 1),
+                        'rejected': len(rejected), 'errors': len(login_errors)}}
+    if args.readers:
+        result['books'] = {**summarize(reads), 'throughput_rps': round(len(reads) / elapsed, 1),
+                           'errors': len(read_errors)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--costs', type=int, nargs='+', default=[12, 13, 14, 15])
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--logins', type=int, default=8)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--hash-workers', type=int, default=2)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    emit({
+        'benchmark': 'login_cost',
+        'revision': git_revision(),
+        'params': {'books': args.books, 'logins': args.logins, 'readers': args.readers,
+                   'duration_s': args.duration, 'workers': args.workers,
+                   'worker_class': args.worker_class, 'hash_workers': args.hash_workers},
+        'scenarios': {f'ln={ln}': run_cost(ln, args) for ln in args.costs},
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
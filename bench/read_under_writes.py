@@ -0,0 +1,132 @@
+"""
+Read throughput on /books with and without concurrent borrow/return traffic.
+
+    python -m bench.read_under_writes --readers 8 --writers 4 --duration 15
+    python -m bench.read_under_writes --journal-mode DELETE   # compare with rollback journal
+
+Runs the same reader load twice against one gunicorn server on a SQLite file:
+first alone, then while --writers clients borrow and return books as fast as
+they can. read_ratio is the second phase's read throughput over the first's.
+In WAL mode readers never wait on the write lock, so with spare CPU it should
+stay close to 1.0 and writers should see no errors; on a machine with fewer
+cores than clients the drop measures CPU sharing and catalog cache
+invalidation rather than locking (compare against --journal-mode DELETE).
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from bench.common import emit, git_revision, make_app, summarize
+from bench.datagen import BENCH_PASSWORD, bench_email, build_dataset
+from bench.loadtest import Client, free_port, start_server
+from models import db, Book
+
+
+def client_loop(base_url, n, deadline, samples, errors, action):
+    client = Client(base_url)
+    client.request('POST', '/login', {'email': bench_email(n), 'password': BENCH_PASSWORD})
+    rng = random.Random(n)
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            ok = action(client, rng)
+        except OSError:
+            ok = False
+            client = Client(base_url)
+            client.request('POST', '/login', {'email': bench_email(n), 'password': BENCH_PASSWORD})
+        samples.append(time.perf_counter() - start)
+        if not ok:
+            errors.append(n)
+
+
+def read(client, rng):
+    status, _ = client.request('GET', '/books')
+    return status == 200
+
+
+def borrow_return(book_ids):
+    def action(client, rng):
+        book_id = rng.choice(book_ids)
+        status, _ = client.request('POST', '/books', {'book_id': book_id, 'action': 'borrow'})
+        if status != 200:
+            return False
+        status, _ = client.request('POST', '/books', {'book_id': book_id, 'action': 'return'})
+        return status == 200
+    return action
+
+
+def phase(base_url, readers, writers, duration, book_ids):
+    deadline = time.monotonic() + duration
+    reads, read_errors, writes, write_errors = [], [], [], []
+    threads = [threading.Thread(target=client_loop,
+                                args=(base_url, n, deadline, reads, read_errors, read))
+               for n in range(readers)]
+    # Writers get their own users and their own slice of the catalog
+    threads += [threading.Thread(target=client_loop,
+                                 args=(base_url, readers + n, deadline, writes, write_errors,
+                                       borrow_return(book_ids[n::writers])))
+                for n in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = {'read': {**summarize(reads), 'throughput_rps': round(len(reads) / elapsed, 1),
+                       'errors': len(read_errors)}}
+    if writers:
+        result['write'] = {**summarize(writes), 'throughput_rps': round(len(writes) / elapsed, 1),
+                           'errors': len(write_errors)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--books', type=int, default=10_000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--journal-mode', default='WAL')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), f'library-bench-rw-{args.books}.db')
+    database_uri = f'sqlite:///{path}'
+    app = make_app(database_uri, SQLITE_JOURNAL_MODE=args.journal_mode)
+    with app.app_context():
+        build_dataset(args.books, args.readers + args.writers)
+        book_ids = list(db.session.scalars(db.select(Book.id).limit(1000)))
+        db.engine.dispose()
+
+    port = free_port()
+    server = start_server(database_uri, args.workers, 'sync', port,
+                          SQLITE_JOURNAL_MODE=args.journal_mode)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        phase(base_url, args.readers, 0, 1, book_ids)  # warm up
+        baseline = phase(base_url, args.readers, 0, args.duration, book_ids)
+        contended = phase(base_url, args.readers, args.writers, args.duration, book_ids)
+    finally:
+        server.terminate()
+        server.wait()
+
+    emit({
+        'benchmark': 'read_under_writes',
+        'revision': git_revision(),
+        'params': {'books': args.books, 'readers': args.readers, 'writers': args.writers,
+                   'duration_s': args.duration, 'workers': args.workers,
+                   'journal_mode': args.journal_mode},
+        'scenarios': {'read_alone': baseline['read'], 'read_with_writes': contended['read'],
+                      'write': contended['write']},
+        'read_ratio': round(contended['read']['throughput_rps'] /
+                            max(baseline['read']['throughput_rps'], 1e-9), 3),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+Read-through cache for catalog pages and search results.
+
+Entries are keyed by the catalog version, a counter bumped in the same
+transaction as every borrow/return. A worker only has to read that one integer
+to know whether its cached pages are still good; stale versions simply stop
+being asked for and age out of the LRU.
+
+The version lives either in the catalog_version table (CATALOG_VERSION_BACKEND
+= 'db', works across hosts) or in a small memory-mapped file shared by the
+workers on one host ('file', no database round-trip at all).
+"""
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, CatalogVersion
+from catalog import Page, catalog_page
+
+# Plain, session-independent copy of a Book row that is safe to share between requests
+BookRow = namedtuple('BookRow', 'id title author available')
+
+
+class LRUCache:
+    """Thread-safe LRU with a per-entry time-to-live"""
+
+    def __init__(self, maxsize=256, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class DatabaseVersion:
+    """Catalog version stored in the catalog_version table"""
+
+    def current(self):
+        version = db.session.scalar(
+            db.select(CatalogVersion.version).where(CatalogVersion.id == 1)
+        )
+        return version or 0
+
+    def bump_in_transaction(self, session):
+        bumped = session.execute(
+            db.update(CatalogVersion)
+            .where(CatalogVersion.id == 1)
+            .values(version=CatalogVersion.version + 1)
+        ).rowcount
+        if not bumped:
+            session.add(CatalogVersion(id=1, version=1))
+
+    def bump_after_commit(self):
+        pass
+
+
+class FileVersion:
+    """Catalog version stored as a 64-bit counter in a memory-mapped file"""
+
+    def __init__(self, path):
+        import fcntl
+        self._fcntl = fcntl
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < 8:
+            os.ftruncate(self._fd, 8)
+        self._map = mmap.mmap(self._fd, 8)
+
+    def current(self):
+        return struct.unpack_from('q', self._map)[0]
+
+    def bump_in_transaction(self, session):
+        # Bumping before the commit is visible would let a reader cache the
+        # old rows under the new version, so defer it to after_commit.
+        session.info['catalog_changed'] = True
+
+    def bump_after_commit(self):
+        self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)
+        try:
+            struct.pack_into('q', self._map, 0, self.current() + 1)
+        finally:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_file_version(session):
+    if session.info.pop('catalog_changed', False):
+        version_store().bump_after_commit()
+        _forget_request_version()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_catalog_change(session):
+    session.info.pop('catalog_changed', None)
+
+
+def version_store():
+    """The catalog version store configured for the current app"""
+    store = current_app.extensions.get('catalog_version')
+    if store is None:
+        if current_app.config.get('CATALOG_VERSION_BACKEND', 'db') == 'file':
+            store = FileVersion(current_app.config['CATALOG_VERSION_FILE'])
+        else:
+            store = DatabaseVersion()
+        current_app.extensions['catalog_version'] = store
+    return store
+
+
+def catalog_changed():
+    """Call inside any transaction that changes book availability, loans or the catalog"""
+    version_store().bump_in_transaction(db.session)
+    _forget_request_version()
+
+
+def catalog_version():
+    """The current catalog version, read at most once per request"""
+    if not has_request_context():
+        return version_store().current()
+    if 'catalog_version' not in g:
+        g.catalog_version = version_store().current()
+    return g.catalog_version
+
+
+def _forget_request_version():
+    if has_request_context():
+        g.pop('catalog_version', None)
+
+
+class CatalogCache:
+    """Read-through cache in front of catalog_page(), plus rendered catalog rows"""
+
+    def __init__(self, maxsize, ttl, row_maxsize=0):
+        self.pages = LRUCache(maxsize, ttl)
+        # Row keys carry everything the markup depends on, so rows never expire
+        self.rows = LRUCache(row_maxsize, math.inf)
+
+    def page(self, q, cursor, limit):
+        key = (catalog_version(), q, cursor, limit)
+        page = self.pages.get(key)
+        if page is None:
+            page = catalog_page(q, cursor, limit)
+            rows = [BookRow(b.id, b.title, b.author, b.available) for b in page.books]
+            page = Page(rows, page.next_cursor)
+            self.pages.set(key, page)
+        return page
+
+    def row(self, key, render):
+        """Rendered markup for `key`, calling render() on a miss"""
+        html = self.rows.get(key)
+        if html is None:
+            html = render()
+            self.rows.set(key, html)
+        return html
+
+    def stats(self):
+        return {
+            'hits': self.pages.hits,
+            'misses': self.pages.misses,
+            'hit_ratio': round(self.pages.hit_ratio, 4),
+            'entries': len(self.pages),
+            'row_hit_ratio': round(self.rows.hit_ratio, 4),
+            'row_entries': len(self.rows),
+        }
+
+
+def init_catalog_cache(app):
+    app.extensions['catalog_cache'] = CatalogCache(
+        app.config.get('CATALOG_CACHE_SIZE', 256),
+        app.config.get('CATALOG_CACHE_TTL', 60.0),
+        app.config.get('CATALOG_ROW_CACHE_SIZE', 20000),
+    )
+    # g outlives a request when an app context was already pushed (tests, CLI)
+    app.before_request(_forget_request_version)
+
+
+def get_catalog_cache():
+    return current_app.extensions['catalog_cache']
@@ -0,0 +1,60 @@
+"""
+Catalog listing with keyset (cursor) pagination.
+
+Pages are ordered by (rank, id) for searches and by id otherwise. The cursor is
+the sort key of the last row on the page, so fetching page N never scans the
+N-1 pages before it the way OFFSET does.
+"""
+from collections import namedtuple
+
+from models import db, Book
+from search import get_search_backend
+
+Cursor = namedtuple('Cursor', 'after rank')
+Page = namedtuple('Page', 'books next_cursor')
+
+
+def catalog_query(q='', cursor=None):
+    """
+    Select of the catalog (optionally filtered by q) positioned after `cursor`,
+    in stable page order. Rows are (Book, rank) tuples; rank is None when unranked.
+    """
+    if q:
+        stmt, rank = get_search_backend().ranked(q)
+    else:
+        stmt, rank = db.select(Book), None
+
+    if rank is None:
+        stmt = stmt.add_columns(db.null().label('rank')).order_by(Book.id)
+        if cursor and cursor.after is not None:
+            stmt = stmt.where(Book.id > cursor.after)
+        return stmt
+
+    stmt = stmt.add_columns(rank.label('rank')).order_by(rank, Book.id)
+    if cursor and cursor.after is not None:
+        if cursor.rank is None:
+            stmt = stmt.where(Book.id > cursor.after)
+        else:
+            stmt = stmt.where(db.or_(
+                rank > cursor.rank,
+                db.and_(rank == cursor.rank, Book.id > cursor.after),
+            ))
+    return stmt
+
+
+def catalog_page(q='', cursor=None, limit=50):
+    """Fetch one page; next_cursor is None on the last page"""
+    rows = db.session.execute(catalog_query(q, cursor).limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_book, last_rank = rows[-1]
+        next_cursor = Cursor(last_book.id, last_rank)
+    return Page([book for book, _ in rows], next_cursor)
+
+
+def iter_catalog(q='', cursor=None, chunk_size=500):
+    """Stream every matching book without materializing the result set"""
+    stmt = catalog_query(q, cursor).execution_options(yield_per=chunk_size)
+    for book, _ in db.session.execute(stmt):
+        yield book
@@ -0,0 +1,191 @@
+"""
+Flask CLI commands (run with `flask --app app <command>`)
+"""
+import csv
+import os
+import time
+
+import click
+from sqlalchemy.exc import OperationalError
+from flask.cli import with_appcontext
+
+from models import db, Book
+from loans import migrate_borrowed_books
+from overdue import add_due_dates, sweep_overdue
+from stats import fold_stats, rebuild_stats
+from passwords import hash_plaintext_passwords
+from search import rebuild_search_index
+from importer import guess_format, import_books, import_users, read_rows
+
+
+SEED_BOOKS = [
+    ('The Great Gatsby', 'F. Scott Fitzgerald'),
+    ('1984', 'George Orwell'),
+    ('To Kill a Mockingbird', 'Harper Lee'),
+]
+
+
+def seed_books():
+    """Add the starter catalog to an empty book table; returns how many were added"""
+    if db.session.scalar(db.select(Book.id).limit(1)) is not None:
+        return 0
+    db.session.add_all([Book(title=title, author=author) for title, author in SEED_BOOKS])
+    db.session.commit()
+    return len(SEED_BOOKS)
+
+
+def init_db(seed=False):
+    """Create any missing tables (and search index), optionally seeding books"""
+    db.create_all()
+    if seed:
+        seed_books()
+
+
+@click.command('init-db')
+@click.option('--seed/--no-seed', default=False, help='Also add the starter books if empty.')
+@click.option('--wait', default=0, show_default=True,
+              help='Seconds to keep retrying while the database is unreachable.')
+@with_appcontext
+def init_db_command(seed, wait):
+    """Create the database schema."""
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            init_db(seed)
+            break
+        except OperationalError as e:
+            if time.monotonic() >= deadline:
+                raise click.ClickException(f'Database unavailable: {e.orig}')
+            db.session.rollback()
+            time.sleep(1)
+    click.echo('Database initialized.')
+
+
+@click.command('seed-books')
+@with_appcontext
+def seed_books_command():
+    """Add the starter books to an empty catalog."""
+    click.echo(f'Seeded {seed_books()} books.')
+
+
+@click.command('migrate-loans')
+@with_appcontext
+def migrate_loans_command():
+    """Convert legacy User.borrowed_books strings into Loan rows and add due dates."""
+    db.create_all()
+    backfilled = add_due_dates()
+    created = migrate_borrowed_books()
+    click.echo(f'Migrated {created} loans.')
+    click.echo(f'Gave {backfilled} open loans a due date.')
+
+
+@click.command('sweep-overdue')
+@click.option('--batch-size', default=1000, show_default=True, help='Loans per transaction.')
+@click.option('--pause', default=0.0, show_default=True,
+              help='Seconds to sleep between batches, leaving room for live traffic.')
+@with_appcontext
+def sweep_overdue_command(batch_size, pause):
+    """Recompute late fees on open loans that are past due."""
+    stats = sweep_overdue(batch_size=batch_size, pause=pause)
+    click.echo(stats.summary())
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """Create the full-text index on an existing database and repopulate it."""
+    dialect = rebuild_search_index()
+    click.echo(f'Search index rebuilt for {dialect}.')
+
+
+@click.command('import-books')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format (default: guessed from the file extension).')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per INSERT.')
+@click.option('--commit-every', default=10, show_default=True, help='Batches per commit.')
+@with_appcontext
+def import_books_command(source, fmt, batch_size, commit_every):
+    """Stream books from a CSV (title,author header) or JSONL file; '-' reads stdin."""
+    fmt = fmt or guess_format(os.path.basename(source.name))
+    stats = import_books(read_rows(source, fmt), batch_size, commit_every,
+                         progress=lambda s: click.echo(s.summary(), err=True))
+    for error in stats.errors:
+        click.echo(f'  skipped {error}', err=True)
+    click.echo(f'Imported {stats.inserted} books ({stats.rate:,.0f} rows/sec).')
+
+
+@click.command('import-users')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format (default: guessed from the file extension).')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per INSERT.')
+@click.option('--hash-workers', type=int, help='Threads hashing roster passwords '
+              '(default: one per CPU).')
+@click.option('--duplicates', 'duplicates_file', type=click.File('w', encoding='utf-8'),
+              help='Write every skipped duplicate here as CSV.')
+@with_appcontext
+def import_users_command(source, fmt, batch_size, hash_workers, duplicates_file):
+    """Provision accounts from a roster (user_id,name,email[,password]); '-' reads stdin."""
+    fmt = fmt or guess_format(os.path.basename(source.name))
+    shown = []
+    report = None
+    if duplicates_file:
+        report = csv.writer(duplicates_file)
+        report.writerow(['record', 'user_id', 'name', 'email', 'duplicate'])
+
+    def on_duplicate(record_no, row, field):
+        if len(shown) < 10:
+            shown.append(f'record {record_no}: {field} {row[field]!r} already exists')
+        if report:
+            report.writerow([record_no, row['user_id'], row['name'], row['email'], field])
+
+    stats = import_users(read_rows(source, fmt), batch_size, hash_workers or os.cpu_count(),
+                         progress=lambda s: click.echo(s.summary(), err=True),
+                         on_duplicate=on_duplicate)
+    for line in shown + [f'skipped {error}' for error in stats.errors]:
+        click.echo(f'  {line}', err=True)
+    click.echo(f'Imported {stats.inserted} users, skipped {stats.duplicates} duplicates '
+               f'({stats.rate:,.0f} rows/sec).')
+
+
+@click.command('fold-stats')
+@click.option('--batch-size', default=1000, show_default=True, help='Events per transaction.')
+@with_appcontext
+def fold_stats_command(batch_size):
+    """Fold the loan event log into the circulation counters."""
+    click.echo(f'Folded {fold_stats(batch_size)} loan events.')
+
+
+@click.command('rebuild-stats')
+@click.option('--check', is_flag=True, help='Only report drift; leave the counters alone.')
+@with_appcontext
+def rebuild_stats_command(check):
+    """Recompute the circulation counters from the loan table."""
+    if not check:
+        db.create_all()
+    drift = rebuild_stats(check)
+    for table, rows in drift.items():
+        click.echo(f'{table}: {rows} rows differ')
+    click.echo('Checked, nothing written.' if check else 'Counters rebuilt.')
+
+
+@click.command('hash-passwords')
+@click.option('--batch-size', default=500, show_default=True, help='Users per transaction.')
+@with_appcontext
+def hash_passwords_command(batch_size):
+    """Hash passwords still stored in plaintext (the rest upgrade on login)."""
+    click.echo(f'Hashed {hash_plaintext_passwords(batch_size)} passwords.')
+
+
+def register_commands(app):
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(seed_books_command)
+    app.cli.add_command(migrate_loans_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(import_books_command)
+    app.cli.add_command(import_users_command)
+    app.cli.add_command(sweep_overdue_command)
+    app.cli.add_command(fold_stats_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(hash_passwords_command)
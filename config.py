@@ -0,0 +1,113 @@
+"""
+Default settings, overridable through environment variables.
+create_app(config) applies its mapping on top of these.
+"""
+import os
+
+
+def env_flag(name, default):
+    return os.getenv(name, str(int(default))).lower() in ('1', 'true', 'yes', 'on')
+
+
+def engine_options():
+    """Connection pool settings from DB_POOL_*; unset ones keep SQLAlchemy's defaults"""
+    options = {'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True)}
+    for option, name, cast in (('pool_size', 'DB_POOL_SIZE', int),
+                               ('max_overflow', 'DB_MAX_OVERFLOW', int),
+                               ('pool_recycle', 'DB_POOL_RECYCLE', int),
+                               ('pool_timeout', 'DB_POOL_TIMEOUT', float)):
+        if os.getenv(name):
+            options[option] = cast(os.getenv(name))
+    return options
+
+
+class Config:
+    SECRET_KEY = os.getenv('SECRET_KEY', 'your_secret_key')
+    SQLALCHEMY_DATABASE_URI = os.getenv(
+        'SQLALCHEMY_DATABASE_URI',
+        'sqlite:///library.db'  #本地开发默认
+    )
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options()
+
+    # Comma-separated read replicas; replica_reads() blocks may query them.
+    # After a write the user reads from the primary for REPLICA_LAG_SECONDS.
+    SQLALCHEMY_REPLICA_URIS = [uri.strip() for uri in
+                               os.getenv('SQLALCHEMY_REPLICA_URIS', '').split(',') if uri.strip()]
+    REPLICA_LAG_SECONDS = float(os.getenv('REPLICA_LAG_SECONDS', 5))
+
+    # Connection pragmas and write serialization when the database is SQLite
+    SQLITE_TUNING = env_flag('SQLITE_TUNING', True)
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024))  # negative = KiB
+    # Queue writers from all workers on an flock next to the database file
+    SQLITE_WRITE_LOCK = env_flag('SQLITE_WRITE_LOCK', True)
+
+    # Create the schema and seed books on the first request instead of at
+    # import time. Deployments turn this off and run `flask init-db` instead.
+    AUTO_INIT_DB = env_flag('AUTO_INIT_DB', True)
+
+    # like | fts5 | fulltext | auto (pick by database dialect)
+    SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'auto')
+    # Most completions /api/suggest returns
+    SUGGEST_LIMIT = int(os.getenv('SUGGEST_LIMIT', 10))
+    BOOKS_PAGE_SIZE = int(os.getenv('BOOKS_PAGE_SIZE', 50))
+    BOOKS_MAX_PAGE_SIZE = int(os.getenv('BOOKS_MAX_PAGE_SIZE', 500))
+    # Rows fetched per round-trip when /books?stream=1 streams the whole catalog
+    BOOKS_STREAM_CHUNK = int(os.getenv('BOOKS_STREAM_CHUNK', 500))
+
+    # Catalog page cache: entries, seconds to live, and where the version counter lives
+    CATALOG_CACHE_SIZE = int(os.getenv('CATALOG_CACHE_SIZE', 256))
+    CATALOG_CACHE_TTL = float(os.getenv('CATALOG_CACHE_TTL', 60))
+    CATALOG_ROW_CACHE_SIZE = int(os.getenv('CATALOG_ROW_CACHE_SIZE', 20000))  # rendered rows
+    # Compiled templates are kept here across restarts; unset compiles in memory only
+    JINJA_BYTECODE_CACHE_DIR = os.getenv('JINJA_BYTECODE_CACHE_DIR') or None
+    CATALOG_VERSION_BACKEND = os.getenv('CATALOG_VERSION_BACKEND', 'db')  # db | file
+    CATALOG_VERSION_FILE = os.getenv('CATALOG_VERSION_FILE', '/tmp/library-catalog.version')
+    # Loans and holds cached in the session cookie; more are re-read each request
+    SESSION_LOANS_MAX = int(os.getenv('SESSION_LOANS_MAX', 64))
+
+    # Availability events for /events: a file all workers append to and tail
+    # (unset keeps events within one process), and SSE connection timings
+    EVENTS_FILE = os.getenv('EVENTS_FILE') or None
+    EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', 0.2))
+    EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', 15))
+    EVENTS_MAX_AGE = float(os.getenv('EVENTS_MAX_AGE', 300))
+    # A stream pins a sync worker, so gunicorn.conf turns it off unless workers are
+    # async; books.html then polls /api/v1/books/availability every POLL seconds
+    EVENTS_STREAM = env_flag('EVENTS_STREAM', True)
+    EVENTS_POLL_SECONDS = float(os.getenv('EVENTS_POLL_SECONDS', 30))
+
+    # scrypt cost (N = 2**LN) for new hashes; logins rehash older ones. Hashing
+    # runs on PASSWORD_HASH_WORKERS threads per process with at most
+    # PASSWORD_HASH_QUEUE logins waiting before the rest get a 503.
+    PASSWORD_SCRYPT_LN = int(os.getenv('PASSWORD_SCRYPT_LN', 14))
+    PASSWORD_SCRYPT_R = int(os.getenv('PASSWORD_SCRYPT_R', 8))
+    PASSWORD_SCRYPT_P = int(os.getenv('PASSWORD_SCRYPT_P', 1))
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', 32))
+
+    # Login/registration attempts per client address and per email, as
+    # "<count>/<second|minute|hour|day>"; empty disables one. The storage is
+    # memory://, mmap:///path, sqlite:///path or redis://host:port/db.
+    RATELIMIT_ENABLED = env_flag('RATELIMIT_ENABLED', True)
+    RATELIMIT_STORAGE_URI = os.getenv('RATELIMIT_STORAGE_URI', 'memory://')
+    RATELIMIT_SLOTS = int(os.getenv('RATELIMIT_SLOTS', 4096))  # mmap table size
+    RATELIMIT_LOGIN_IP = os.getenv('RATELIMIT_LOGIN_IP', '30/minute')
+    RATELIMIT_LOGIN_EMAIL = os.getenv('RATELIMIT_LOGIN_EMAIL', '10/minute')
+    RATELIMIT_REGISTER_IP = os.getenv('RATELIMIT_REGISTER_IP', '10/hour')
+    RATELIMIT_REGISTER_EMAIL = os.getenv('RATELIMIT_REGISTER_EMAIL', '3/hour')
+
+    # Loan period and the late fee `flask sweep-overdue` charges per day started
+    LOAN_PERIOD_DAYS = int(os.getenv('LOAN_PERIOD_DAYS', 14))
+    FINE_PER_DAY_CENTS = int(os.getenv('FINE_PER_DAY_CENTS', 25))
+    FINE_MAX_CENTS = int(os.getenv('FINE_MAX_CENTS', 2000))
+
+    # Per-worker metrics files summed by /metrics; unset keeps metrics in-process
+    METRICS_DIR = os.getenv('METRICS_DIR') or None
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 1.0))
+    # Log requests slower than this (with their SQL); 0 disables
+    SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 0))
@@ -0,0 +1,127 @@
+"""
+Shared fixtures for test_app.py.
+
+The schema is created once per test process, in an on-disk SQLite file of
+its own (pytest-xdist workers each get one, so `pytest -n auto` needs no
+coordination). Each test gets a fresh app whose engine points at that file.
+The `app` fixture opens a connection, begins a transaction and makes
+db.session join it through a SAVEPOINT. The code under test can commit and
+roll back as usual, and everything is undone when the test ends instead of
+dropping and recreating every table.
+
+Tests that need committed data visible to other connections (threads with
+their own app context, DDL through db.engine) build their own app, as the
+concurrency and migration tests already do.
+
+A timing summary is printed after the run: time spent in setup, call and
+teardown, and the slowest tests (--timing-top).
+"""
+import os
+from collections import defaultdict
+
+import pytest
+from flask import current_app
+
+from app import create_app
+from models import db, Book
+from replicas import RoutingSession
+
+TEST_CONFIG = {
+    'TESTING': True,
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+    'SECRET_KEY': 'test_secret_key',
+    'WTF_CSRF_ENABLED': False,
+    'AUTO_INIT_DB': False,
+    # Cheap hashes keep the suite fast; the format is the same
+    'PASSWORD_SCRYPT_LN': 4,
+}
+
+
+class TransactionalSession(RoutingSession):
+    """A db.session that joins the connection the `app` fixture holds open"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            bind = current_app.extensions.get('test_connection')
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# Only sessions in an app carrying a test_connection are affected
+db.session.session_factory.class_ = TransactionalSession
+db.session.session_factory.configure(join_transaction_mode='create_savepoint')
+
+
+@pytest.fixture(scope='session')
+def database_uri(tmp_path_factory):
+    """This worker's database file, with the schema already created"""
+    worker = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+    path = tmp_path_factory.mktemp('db') / f'test-{worker}.db'
+    uri = f'sqlite:///{path}'
+    schema_app = create_app({**TEST_CONFIG, 'SQLALCHEMY_DATABASE_URI': uri})
+    with schema_app.app_context():
+        db.create_all()
+        db.engine.dispose()
+    return uri
+
+
+@pytest.fixture
+def app(database_uri):
+    """Create and configure a test app instance."""
+    flask_app = create_app({**TEST_CONFIG, 'SQLALCHEMY_DATABASE_URI': database_uri})
+
+    with flask_app.app_context():
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        flask_app.extensions['test_connection'] = connection
+        try:
+            yield flask_app
+        finally:
+            db.session.remove()
+            transaction.rollback()
+            connection.close()
+            db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    """Create a test client for the app."""
+    return app.test_client()
+
+
+@pytest.fixture
+def init_database(app):
+    """Initialize database with test data."""
+    with app.app_context():
+        # Add some test books
+        book1 = Book(title='Test Book 1', author='Author 1')
+        book2 = Book(title='Test Book 2', author='Author 2')
+        db.session.add_all([book1, book2])
+        db.session.commit()
+        yield db
+
+
+def pytest_addoption(parser):
+    parser.addoption('--timing-top', type=int, default=5,
+                     help='Slowest tests to list in the timing summary (0 hides it).')
+
+
+_durations = defaultdict(float)
+_phases = defaultdict(float)
+
+
+def pytest_runtest_logreport(report):
+    _phases[report.when] += report.duration
+    _durations[report.nodeid] += report.duration
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    top = config.getoption('timing_top')
+    if not top or not _durations:
+        return
+    terminalreporter.section('timing')
+    terminalreporter.write_line(
+        f'{len(_durations)} tests: ' +
+        ', '.join(f'{phase} {_phases[phase]:.2f}s' for phase in ('setup', 'call', 'teardown')))
+    slowest = sorted(_durations.items(), key=lambda item: item[1], reverse=True)[:top]
+    for nodeid, seconds in slowest:
+        terminalreporter.write_line(f'{seconds:8.2f}s  {nodeid}')
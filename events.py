@@ -0,0 +1,157 @@
+"""
+Live availability changes pushed to browsers over server-sent events.
+
+Borrow and return record the books they change in the session; once the
+transaction commits, one {"book_id", "available"} event per book is published.
+Within a worker, subscribers each have a queue that the publisher fans out to.
+Across workers, events go through EVENTS_FILE instead: publishers append a
+JSON line to it and every worker runs one thread tailing it, which stands in
+for a Redis pub/sub channel on a single host. Without EVENTS_FILE events stay
+inside the process.
+
+An open /events connection only waits on its queue and never holds a
+database connection, so a gevent worker can keep thousands of them open.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class EventBus:
+    """In-process pub/sub, optionally fed from a file shared by all workers"""
+
+    def __init__(self, path=None, poll_interval=0.2, queue_size=1000):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._tailer_pid = None
+
+    def subscribe(self):
+        if self.path:
+            self._ensure_tailer()
+        subscriber = queue.Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, events):
+        if not events:
+            return
+        if not self.path:
+            self._dispatch(events)
+            return
+        # One write() per batch; O_APPEND keeps concurrent writers from interleaving
+        data = ''.join(json.dumps(e, separators=(',', ':')) + '\n' for e in events).encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _dispatch(self, events):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            for e in events:
+                try:
+                    subscriber.put_nowait(e)
+                except queue.Full:
+                    break  # a stalled client only misses updates; it reloads on reconnect
+
+    def _ensure_tailer(self):
+        with self._lock:
+            if self._tailer_pid == os.getpid():
+                return
+            # Threads don't survive fork, so each worker starts its own
+            self._tailer_pid = os.getpid()
+        # Start from the current end, measured before subscribe() returns
+        offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        tailer = threading.Thread(target=self._tail, args=(offset,), daemon=True)
+        tailer.start()
+
+    def _tail(self, offset):
+        partial = b''
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                with open(self.path, 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if size < offset:
+                        offset, partial = 0, b''  # the file was truncated or replaced
+                    f.seek(offset)
+                    chunk = f.read()
+            except FileNotFoundError:
+                offset, partial = 0, b''
+                continue
+            if not chunk:
+                continue
+            offset += len(chunk)
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            events = []
+            for line in lines:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+            self._dispatch(events)
+
+
+def availability_changed(session, book_id, available):
+    """Call inside the transaction that flips a book's availability"""
+    session.info.setdefault('availability_events', {})[book_id] = available
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_availability(session):
+    changes = session.info.pop('availability_events', None)
+    if changes:
+        get_event_bus().publish([{'book_id': book_id, 'available': available}
+                                 for book_id, available in changes.items()])
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_availability(session):
+    session.info.pop('availability_events', None)
+
+
+def get_event_bus(app=None):
+    return (app or current_app).extensions['events']
+
+
+def init_events(app):
+    app.extensions['events'] = EventBus(app.config.get('EVENTS_FILE'),
+                                        app.config.get('EVENTS_POLL_INTERVAL', 0.2))
+
+
+def sse_stream(bus, heartbeat=15.0, max_age=300.0):
+    """
+    Yield server-sent event frames until the client goes away. Comments are
+    sent every `heartbeat` seconds so dead connections are noticed, and the
+    stream ends after `max_age` so the browser reconnects to a fresh worker.
+    """
+    subscriber = bus.subscribe()
+    deadline = time.monotonic() + max_age
+    try:
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < deadline:
+            try:
+                e = subscriber.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield f'data: {json.dumps(e, separators=(",", ":"))}\n\n'
+    finally:
+        bus.unsubscribe(subscriber)
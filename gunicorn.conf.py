@@ -0,0 +1,59 @@
+"""
+Gunicorn settings: `gunicorn -c gunicorn.conf.py app:app`
+
+The app is preloaded in the master so workers fork from an already-imported,
+warm parent instead of each importing Flask/SQLAlchemy on boot.
+"""
+import multiprocessing
+import os
+import shutil
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+# Open connections per gevent worker; /events streams stay open for minutes
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 2000))
+preload_app = True
+
+if worker_class == 'gevent':
+    # Patch before the preloaded app creates its locks and pools
+    from gevent import monkey
+    monkey.patch_all()
+
+# Each /events stream would hold a sync or threaded worker for EVENTS_MAX_AGE;
+# without an async worker books.html polls for availability instead
+os.environ.setdefault('EVENTS_STREAM', '1' if worker_class in ('gevent', 'eventlet') else '0')
+
+# Workers write their metrics here so any of them can serve /metrics for all
+os.environ.setdefault('METRICS_DIR', '/tmp/library-metrics')
+# ...share login/registration rate limits through this file...
+os.environ.setdefault('RATELIMIT_STORAGE_URI', 'mmap:///tmp/library-ratelimit')
+# ...keep compiled templates here across restarts...
+os.environ.setdefault('JINJA_BYTECODE_CACHE_DIR', '/tmp/library-jinja-cache')
+# ...and append availability events here, which every worker tails for /events
+os.environ.setdefault('EVENTS_FILE', '/tmp/library-events.log')
+
+
+def on_starting(server):
+    # Counters restart with the master; drop files left by a previous run
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+    if os.path.exists(os.environ['EVENTS_FILE']):
+        os.remove(os.environ['EVENTS_FILE'])
+
+
+def when_ready(server):
+    # Compile templates once in the preloaded master; workers inherit them
+    from app import app
+    from templating import warm_templates
+    warm_templates(app)
+
+
+def post_fork(server, worker):
+    # Pooled connections opened in the master must not be shared across
+    # processes; drop them without closing the parent's sockets.
+    from app import app
+    from models import db
+    from replicas import replica_engines
+    with app.app_context():
+        for engine in list(db.engines.values()) + replica_engines(app):
+            engine.dispose(close=False)
@@ -0,0 +1,251 @@
+"""
+Streaming bulk import of publisher catalog feeds and user rosters.
+
+Rows are parsed one at a time, validated, de-duplicated (books on title and
+author, users on user_id and email) and inserted with executemany in
+fixed-size batches, so memory use depends on the batch size and not on the
+size of the feed.
+"""
+import csv
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Book, User
+from cache import catalog_changed
+from passwords import UNUSABLE_PASSWORD, get_hasher, make_hash
+from sqlite_mode import write_transaction
+from users import UNIQUE_FIELDS, duplicate_field
+
+TITLE_MAX = Book.__table__.c.title.type.length
+AUTHOR_MAX = Book.__table__.c.author.type.length
+USER_MAX = {name: User.__table__.c[name].type.length for name in ('user_id', 'name', 'email')}
+
+
+class ImportStats:
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self):
+        return self.read / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (f'{self.read} read, {self.inserted} inserted, {self.duplicates} duplicates, '
+                f'{self.invalid} invalid in {self.elapsed:.1f}s ({self.rate:,.0f} rows/sec)')
+
+
+def read_rows(stream, fmt):
+    """
+    Yield one record per row of a CSV (with header) or JSON Lines stream. JSON
+    lines are yielded undecoded; as_record() parses them during validation, so
+    one malformed line is counted as invalid instead of ending the import.
+    """
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    elif fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                yield line
+    else:
+        raise ValueError(f'Unsupported format: {fmt}')
+
+
+def guess_format(filename):
+    return 'jsonl' if filename.endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def as_record(record):
+    """A record as a dict, decoding a raw JSON line; raises ValueError if it isn't an object"""
+    if isinstance(record, str):
+        try:
+            record = json.loads(record)
+        except ValueError as e:
+            raise ValueError(f'invalid JSON: {e}') from None
+    if not isinstance(record, dict):
+        raise ValueError('record is not an object')
+    return record
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def clean_book(record):
+    """Return insertable column values for one feed record, or raise ValueError"""
+    record = as_record(record)
+    title = (record.get('title') or '').strip()
+    author = (record.get('author') or '').strip()
+    if not title or not author:
+        raise ValueError('title and author are required')
+    if len(title) > TITLE_MAX or len(author) > AUTHOR_MAX:
+        raise ValueError('title or author too long')
+    return {'title': title, 'author': author, 'available': True}
+
+
+def insert_new_books(rows):
+    """Insert the rows whose (title, author) isn't in the database yet; return them"""
+    unique = {}
+    for row in rows:
+        unique.setdefault((row['title'], row['author']), row)
+    key = db.tuple_(Book.title, Book.author)
+    existing = {tuple(row) for row in db.session.execute(
+        db.select(Book.title, Book.author).where(key.in_(list(unique)))
+    )}
+    fresh = [row for key, row in unique.items() if key not in existing]
+    if fresh:
+        db.session.execute(db.insert(Book), fresh)
+    return fresh
+
+
+def import_books(records, batch_size=1000, commit_every=10, progress=None):
+    """
+    Import an iterable of feed records. Commits every `commit_every` batches and
+    calls progress(stats) after each commit.
+    """
+    stats = ImportStats()
+
+    def valid_rows():
+        for line_no, record in enumerate(records, start=1):
+            stats.read += 1
+            try:
+                yield clean_book(record)
+            except (ValueError, AttributeError) as e:
+                stats.invalid += 1
+                if len(stats.errors) < 10:
+                    stats.errors.append(f'record {line_no}: {e}')
+
+    pending = 0
+    for batch in batched(valid_rows(), batch_size):
+        fresh = insert_new_books(batch)
+        stats.inserted += len(fresh)
+        stats.duplicates += len(batch) - len(fresh)
+        pending += 1
+        if pending >= commit_every:
+            catalog_changed()
+            db.session.commit()
+            pending = 0
+            if progress:
+                progress(stats)
+    if pending:
+        catalog_changed()
+        db.session.commit()
+        if progress:
+            progress(stats)
+    return stats
+
+
+def clean_user(record):
+    """Return a roster record's user_id, name, email and plain password (or None)"""
+    record = as_record(record)
+    row = {name: (record.get(name) or '').strip() for name in USER_MAX}
+    if not all(row.values()):
+        raise ValueError('user_id, name and email are required')
+    if any(len(row[name]) > limit for name, limit in USER_MAX.items()):
+        raise ValueError('user_id, name or email too long')
+    if '@' not in row['email']:
+        raise ValueError(f"invalid email {row['email']!r}")
+    row['password'] = record.get('password') or None
+    return row
+
+
+def _claim_unique(numbered, on_duplicate):
+    """Drop rows whose user_id or email is taken or repeats an earlier row; return the rest"""
+    seen = {field: set() for field in UNIQUE_FIELDS}
+    existing = {field: set() for field in UNIQUE_FIELDS}
+    for user_id, email in db.session.execute(
+        db.select(User.user_id, User.email).where(db.or_(
+            User.user_id.in_([row['user_id'] for _, row in numbered]),
+            User.email.in_([row['email'] for _, row in numbered]),
+        ))
+    ):
+        existing['user_id'].add(user_id)
+        existing['email'].add(email)
+    fresh = []
+    for record_no, row in numbered:
+        field = next((f for f in UNIQUE_FIELDS if row[f] in existing[f] or row[f] in seen[f]),
+                     None)
+        if field is not None:
+            on_duplicate(record_no, row, field)
+            continue
+        fresh.append((record_no, row))
+        for f in UNIQUE_FIELDS:
+            seen[f].add(row[f])
+    return fresh
+
+
+def import_users(records, batch_size=1000, hash_workers=None, progress=None,
+                 on_duplicate=None):
+    """
+    Provision accounts from roster records, committing each batch. Rows whose
+    user_id or email already exists, or appears earlier in the roster, are
+    skipped and passed to on_duplicate(record_no, row, field). Passwords in
+    the roster are hashed at the configured cost on `hash_workers` threads;
+    rows without one get an unusable password, so they can't be logged into.
+    """
+    stats = ImportStats()
+    params = get_hasher().params
+
+    def valid_rows():
+        for record_no, record in enumerate(records, start=1):
+            stats.read += 1
+            try:
+                yield record_no, clean_user(record)
+            except (ValueError, AttributeError) as e:
+                stats.invalid += 1
+                if len(stats.errors) < 10:
+                    stats.errors.append(f'record {record_no}: {e}')
+
+    def duplicate(record_no, row, field):
+        stats.duplicates += 1
+        if on_duplicate:
+            on_duplicate(record_no, row, field)
+
+    def hashed(row):
+        password = row.pop('password')
+        row['password'] = make_hash(password, **params) if password else UNUSABLE_PASSWORD
+        return row
+
+    with ThreadPoolExecutor(hash_workers) as pool:  # hashlib.scrypt releases the GIL
+        for batch in batched(valid_rows(), batch_size):
+            # Hash before taking the write lock: a duplicate costs a wasted
+            # hash, but no other writer waits on scrypt
+            rows = pool.map(hashed, (row for _, row in batch))
+            batch = [(record_no, row) for (record_no, _), row in zip(batch, rows)]
+            try:
+                with write_transaction():
+                    fresh = _claim_unique(batch, duplicate)
+                    if fresh:
+                        db.session.execute(db.insert(User), [row for _, row in fresh])
+                    db.session.commit()
+                stats.inserted += len(fresh)
+            except IntegrityError:
+                # Someone registered one of these meanwhile: go row by row
+                for record_no, row in fresh:
+                    try:
+                        with write_transaction():
+                            db.session.execute(db.insert(User), row)
+                            db.session.commit()
+                        stats.inserted += 1
+                    except IntegrityError as e:
+                        field = duplicate_field(e)
+                        if field is None:
+                            raise
+                        duplicate(record_no, row, field)
+            if progress:
+                progress(stats)
+    return stats
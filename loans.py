@@ -0,0 +1,319 @@
+"""
+Loan bookkeeping: borrowing, returning, holds and looking up a user's active loans
+
+A book that is out can be put on hold. Each book's queue has two counters,
+the last ticket issued and the last one served; a returned book goes straight
+to the holder of ticket served + 1 in the returning transaction, so it never
+shows as available while someone is waiting. Book rows are locked before
+their queue row everywhere, so returns and new holds on a book serialize.
+"""
+from datetime import timedelta
+
+from flask import current_app
+
+from models import db, Book, Hold, HoldQueue, Loan, utcnow
+from cache import catalog_changed
+from sqlite_mode import write_transaction
+from events import availability_changed
+from stats import record_loan_events
+
+
+def active_loan_ids(user_id):
+    """Return the set of book ids the user currently has on loan"""
+    ids = db.session.scalars(
+        db.select(Loan.book_id).where(Loan.user_id == user_id, Loan.returned_at.is_(None))
+    )
+    return set(ids)
+
+
+def loans_and_holds(user_id):
+    """The user's loaned book ids and {book_id: queue position}, in one round-trip"""
+    rows = db.session.execute(db.union_all(
+        db.select(Loan.book_id, db.null().label('position'))
+        .where(Loan.user_id == user_id, Loan.returned_at.is_(None)),
+        db.select(Hold.book_id, (Hold.ticket - HoldQueue.served).label('position'))
+        .join(HoldQueue, HoldQueue.book_id == Hold.book_id)
+        .where(Hold.user_id == user_id),
+    )).all()
+    return ({book_id for book_id, position in rows if position is None},
+            {book_id: position for book_id, position in rows if position is not None})
+
+
+def due_date(borrowed_at):
+    return borrowed_at + timedelta(days=current_app.config.get('LOAN_PERIOD_DAYS', 14))
+
+
+def borrow_book(user_id, book_id):
+    """
+    Lend a book to the user. The availability check and the flip happen in one
+    conditional UPDATE, so concurrent borrowers in other workers can't both win.
+    Returns False if the book is already out.
+    """
+    with write_transaction():
+        claimed = db.session.execute(
+            db.update(Book)
+            .where(Book.id == book_id, Book.available == True)  # noqa: E712
+            .values(available=False)
+        ).rowcount
+        if claimed != 1:
+            db.session.rollback()
+            return False
+        now = utcnow()
+        db.session.add(Loan(user_id=user_id, book_id=book_id, borrowed_at=now,
+                            due_at=due_date(now)))
+        record_loan_events([(book_id, user_id, True)], now)
+        availability_changed(db.session, book_id, False)
+        catalog_changed()
+        db.session.commit()
+    return True
+
+
+def return_book(user_id, book_id):
+    """
+    Close the user's active loan on the book and make it available again.
+    Returns False if they don't hold it.
+    """
+    with write_transaction():
+        closed = db.session.execute(
+            db.update(Loan)
+            .where(Loan.user_id == user_id, Loan.book_id == book_id, Loan.returned_at.is_(None))
+            .values(returned_at=utcnow())
+        ).rowcount
+        if closed != 1:
+            db.session.rollback()
+            return False
+        record_loan_events([(book_id, user_id, False)])
+        _release([book_id])
+        catalog_changed()
+        db.session.commit()
+    return True
+
+
+def process_batch(user_id, items):
+    """
+    Borrow and return several books in one transaction. `items` is a list of
+    (book_id, action) pairs with action 'borrow' or 'return'; returns are
+    applied first, so a stack can be swapped in one go. Each pair gets a
+    result: borrowed, returned, already-out, not-borrowed or not-found.
+    """
+    to_return = list(dict.fromkeys(b for b, action in items if action == 'return'))
+    to_borrow = list(dict.fromkeys(b for b, action in items if action != 'return'))
+    try:
+        known, returned, borrowed = _apply_batch(user_id, to_return, to_borrow, per_item=False)
+    except _SetUpdateRaced:
+        known, returned, borrowed = _apply_batch(user_id, to_return, to_borrow, per_item=True)
+
+    results = []
+    for book_id, action in items:
+        if book_id not in known:
+            result = 'not-found'
+        elif action == 'return':
+            result = 'returned' if book_id in returned else 'not-borrowed'
+        else:
+            result = 'borrowed' if book_id in borrowed else 'already-out'
+        results.append((book_id, action, result))
+    return results
+
+
+class _SetUpdateRaced(Exception):
+    pass
+
+
+def _apply_batch(user_id, to_return, to_borrow, per_item):
+    with write_transaction():
+        requested = set(to_return) | set(to_borrow)
+        known = set(db.session.scalars(db.select(Book.id).where(Book.id.in_(requested))))
+        returned = _return_many(user_id, [b for b in to_return if b in known], per_item)
+        borrowed = _borrow_many(user_id, [b for b in to_borrow if b in known], per_item)
+        if returned or borrowed:
+            catalog_changed()
+        db.session.commit()
+    return known, returned, borrowed
+
+
+def _conditional_update(stmt, column, ids, per_item):
+    """
+    Run a conditional UPDATE over `ids` and return the ones it changed. Uses
+    UPDATE ... RETURNING where the database has it. Elsewhere the matching
+    rows are read (FOR UPDATE) and updated by id, and the rowcount must agree;
+    if it doesn't, the whole batch is rolled back and redone one item at a time.
+    """
+    if not ids:
+        return set()
+    if per_item:
+        return {i for i in ids if db.session.execute(stmt.where(column == i)).rowcount == 1}
+    if db.session.get_bind().dialect.update_returning:
+        return set(db.session.scalars(stmt.returning(column)))
+    candidates = set(db.session.scalars(
+        db.select(column).where(stmt.whereclause).with_for_update()
+    ))
+    if candidates:
+        changed = db.session.execute(stmt.where(column.in_(candidates))).rowcount
+        if changed != len(candidates):
+            raise _SetUpdateRaced()
+    return candidates
+
+
+def _borrow_many(user_id, book_ids, per_item):
+    claimed = _conditional_update(
+        db.update(Book)
+        .where(Book.id.in_(book_ids), Book.available == True)  # noqa: E712
+        .values(available=False),
+        Book.id, book_ids, per_item,
+    )
+    if claimed:
+        now = utcnow()
+        db.session.execute(db.insert(Loan), [
+            {'user_id': user_id, 'book_id': book_id, 'borrowed_at': now, 'due_at': due_date(now)}
+            for book_id in claimed
+        ])
+        record_loan_events([(book_id, user_id, True) for book_id in claimed], now)
+        for book_id in claimed:
+            availability_changed(db.session, book_id, False)
+    return claimed
+
+
+def _return_many(user_id, book_ids, per_item):
+    closed = _conditional_update(
+        db.update(Loan)
+        .where(Loan.user_id == user_id, Loan.book_id.in_(book_ids), Loan.returned_at.is_(None))
+        .values(returned_at=utcnow()),
+        Loan.book_id, book_ids, per_item,
+    )
+    if closed:
+        record_loan_events([(book_id, user_id, False) for book_id in closed])
+        _release(closed)
+    return closed
+
+
+def _release(book_ids):
+    """
+    Returned books go to the next holder in their queue; the rest become
+    available. Runs inside the returning transaction.
+    """
+    db.session.execute(db.select(Book.id).where(Book.id.in_(book_ids)).with_for_update())
+    waiting = db.session.scalars(
+        db.select(HoldQueue)
+        .where(HoldQueue.book_id.in_(book_ids), HoldQueue.issued > HoldQueue.served)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    ).all()
+    now = utcnow()
+    promoted = {}
+    for queue in waiting:
+        queue.served += 1
+        hold = db.session.scalars(
+            db.select(Hold).where(Hold.book_id == queue.book_id, Hold.ticket == queue.served)
+        ).one()
+        db.session.delete(hold)
+        db.session.add(Loan(user_id=hold.user_id, book_id=queue.book_id, borrowed_at=now,
+                            due_at=due_date(now)))
+        promoted[queue.book_id] = hold.user_id
+    if promoted:
+        record_loan_events([(book_id, user_id, True) for book_id, user_id in promoted.items()],
+                           now)
+    freed = [book_id for book_id in book_ids if book_id not in promoted]
+    if freed:
+        db.session.execute(db.update(Book).where(Book.id.in_(freed)).values(available=True))
+        for book_id in freed:
+            availability_changed(db.session, book_id, True)
+
+
+def place_hold(user_id, book_id):
+    """
+    Queue the user for a book that is out. Returns (result, position) where
+    result is queued, already-queued, available, already-borrowed or
+    not-found, and position (1 = next in line) is set for the first two.
+    """
+    with write_transaction():
+        available = db.session.execute(
+            db.select(Book.available).where(Book.id == book_id).with_for_update()
+        ).first()
+        if available is None or available[0]:
+            db.session.rollback()
+            return ('not-found' if available is None else 'available'), None
+        if db.session.scalar(db.select(Loan.id).where(
+                Loan.user_id == user_id, Loan.book_id == book_id, Loan.returned_at.is_(None))):
+            db.session.rollback()
+            return 'already-borrowed', None
+
+        queue = db.session.get(HoldQueue, book_id, with_for_update=True, populate_existing=True)
+        if queue is None:
+            queue = HoldQueue(book_id=book_id, issued=0, served=0)
+            db.session.add(queue)
+        ticket = db.session.scalar(
+            db.select(Hold.ticket).where(Hold.book_id == book_id, Hold.user_id == user_id))
+        if ticket is not None:
+            position = ticket - queue.served
+            db.session.rollback()
+            return 'already-queued', position
+
+        queue.issued += 1
+        db.session.add(Hold(user_id=user_id, book_id=book_id, ticket=queue.issued))
+        position = queue.issued - queue.served
+        catalog_changed()
+        db.session.commit()
+    return 'queued', position
+
+
+def cancel_hold(user_id, book_id):
+    """Leave a book's queue; everyone behind moves up one. Returns False if not queued."""
+    with write_transaction():
+        db.session.execute(db.select(Book.id).where(Book.id == book_id).with_for_update())
+        queue = db.session.get(HoldQueue, book_id, with_for_update=True, populate_existing=True)
+        hold = db.session.scalars(
+            db.select(Hold).where(Hold.book_id == book_id, Hold.user_id == user_id)
+        ).first()
+        if hold is None:
+            db.session.rollback()
+            return False
+        db.session.delete(hold)
+        db.session.flush()
+        # Keep tickets dense so positions stay a subtraction
+        db.session.execute(
+            db.update(Hold)
+            .where(Hold.book_id == book_id, Hold.ticket > hold.ticket)
+            .values(ticket=Hold.ticket - 1)
+        )
+        queue.issued -= 1
+        catalog_changed()
+        db.session.commit()
+    return True
+
+
+def migrate_borrowed_books():
+    """
+    One-shot migration of the legacy comma-separated user.borrowed_books column
+    into Loan rows. Safe to run more than once; returns the number of loans created.
+    """
+    columns = {col['name'] for col in db.inspect(db.session.connection()).get_columns('user')}
+    if 'borrowed_books' not in columns:
+        return 0
+
+    legacy_user = db.table('user', db.column('id'), db.column('borrowed_books'))
+    rows = db.session.execute(
+        db.select(legacy_user.c.id, legacy_user.c.borrowed_books).where(
+            legacy_user.c.borrowed_books.is_not(None), legacy_user.c.borrowed_books != ''
+        )
+    ).all()
+
+    created = 0
+    now = utcnow()
+    for user_id, borrowed in rows:
+        wanted = {int(bid) for bid in borrowed.split(',') if bid.strip()}
+        known = set(db.session.scalars(db.select(Book.id).where(Book.id.in_(wanted))))
+        for book_id in sorted(known - active_loan_ids(user_id)):
+            db.session.add(Loan(user_id=user_id, book_id=book_id, borrowed_at=now,
+                                due_at=due_date(now)))
+            created += 1
+        if known:
+            db.session.execute(
+                db.update(Book).where(Book.id.in_(known)).values(available=False)
+            )
+        db.session.execute(
+            db.update(legacy_user).where(legacy_user.c.id == user_id).values(borrowed_books='')
+        )
+    if created:
+        catalog_changed()
+    db.session.commit()
+    return created
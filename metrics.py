@@ -0,0 +1,263 @@
+"""
+Request instrumentation exported in Prometheus text format at /metrics.
+
+Per request we record route latency, how many SQL statements ran and how long
+they took (SQLAlchemy cursor events), and template render time. Each process
+keeps its numbers in memory; when METRICS_DIR is set, it also dumps them to
+its own file there at most every METRICS_FLUSH_INTERVAL seconds, and /metrics
+sums the files of every worker so any worker can answer a scrape.
+
+With SLOW_REQUEST_MS set, requests slower than that are logged together with
+the SQL they issued.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from flask import Response, current_app, g, has_request_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+from models import db
+from replicas import replica_engines
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+HELP = {
+    'library_requests_total': ('counter', 'Requests handled, by route and status.'),
+    'library_request_duration_seconds': ('histogram', 'Time to produce a response.'),
+    'library_db_statements_per_request': ('histogram', 'SQL statements issued per request.'),
+    'library_db_duration_seconds': ('histogram', 'Time spent in the database per request.'),
+    'library_template_render_seconds': ('histogram', 'Template render time.'),
+    'library_catalog_cache_hits_total': ('counter', 'Catalog cache hits.'),
+    'library_catalog_cache_misses_total': ('counter', 'Catalog cache misses.'),
+    'library_catalog_row_cache_hits_total': ('counter', 'Rendered catalog rows reused.'),
+    'library_catalog_row_cache_misses_total': ('counter', 'Catalog rows rendered.'),
+}
+
+slow_log = logging.getLogger('library.slow_requests')
+
+
+class Metrics:
+    """Counters and histograms for one process, plus cross-process collection"""
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        self._pid = None
+        self._path = None
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_total(self, name, labels, value):
+        """Record a running total kept elsewhere (still summed across processes)"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {
+                    'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0
+                }
+            for i, bound in enumerate(hist['buckets']):
+                if value <= bound:
+                    hist['counts'][i] += 1
+                    break
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value]
+                             for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), dict(hist, counts=list(hist['counts']))]
+                               for (name, labels), hist in self._histograms.items()],
+            }
+
+    def flush(self, force=False):
+        """Write this process's snapshot to METRICS_DIR (atomically, rate-limited)"""
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        if self._pid != os.getpid():
+            # Forked workers get their own file even if they inherited this object
+            self._pid = os.getpid()
+            token = uuid.uuid4().hex[:8]
+            self._path = os.path.join(self.directory, f'worker-{self._pid}-{token}.json')
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f'{self._path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, self._path)
+
+    def collect(self):
+        """Merge the snapshots of every process into (counters, histograms)"""
+        snapshots = []
+        if self.directory:
+            self.flush(force=True)
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    try:
+                        with open(os.path.join(self.directory, name)) as f:
+                            snapshots.append(json.load(f))
+                    except (OSError, ValueError):
+                        continue  # a worker is mid-write or just went away
+        else:
+            snapshots.append(self.snapshot())
+
+        counters, histograms = {}, {}
+        for snap in snapshots:
+            for name, labels, value in snap['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, hist in snap['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.get(key)
+                if merged is None:
+                    histograms[key] = dict(hist, counts=list(hist['counts']))
+                else:
+                    merged['counts'] = [a + b for a, b in zip(merged['counts'], hist['counts'])]
+                    merged['sum'] += hist['sum']
+                    merged['count'] += hist['count']
+        return counters, histograms
+
+    def render(self):
+        """Prometheus text exposition format"""
+        counters, histograms = self.collect()
+        lines = []
+        by_name = {}
+        for (name, labels), value in counters.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), hist in histograms.items():
+            by_name.setdefault(name, []).append((labels, hist))
+
+        for name in sorted(by_name):
+            kind, help_text = HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(value['buckets'], value['counts']):
+                    cumulative += count
+                    le = format_labels(labels + (('le', repr(float(bound))),))
+                    lines.append(f'{name}_bucket{le} {cumulative}')
+                le = format_labels(labels + (('le', '+Inf'),))
+                lines.append(f'{name}_bucket{le} {value["count"]}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value["sum"]}')
+                lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in labels) + '}'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # On the statement's own context: after_cursor_execute is skipped when it raises
+    context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_start
+    if has_request_context() and 'metrics_start' in g:
+        g.sql_count += 1
+        g.sql_time += elapsed
+        if g.sql_log is not None:
+            g.sql_log.append((elapsed, statement))
+
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context():
+        g.render_start = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    if has_request_context() and 'render_start' in g:
+        get_metrics(sender).observe('library_template_render_seconds',
+                                    {'template': template.name or 'string'},
+                                    time.perf_counter() - g.pop('render_start'))
+
+
+def get_metrics(app=None):
+    return (app or current_app).extensions['metrics']
+
+
+def init_metrics(app):
+    metrics = Metrics(app.config.get('METRICS_DIR'), app.config.get('METRICS_FLUSH_INTERVAL', 1.0))
+    app.extensions['metrics'] = metrics
+
+    with app.app_context():
+        engines = list(db.engines.values()) + replica_engines(app)
+    for engine in engines:
+        if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        g.sql_count = 0
+        g.sql_time = 0.0
+        g.sql_log = [] if app.config.get('SLOW_REQUEST_MS') else None
+
+    @app.after_request
+    def record_request(response):
+        if 'metrics_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.metrics_start
+        endpoint = request.endpoint or 'unmatched'
+        route = {'endpoint': endpoint, 'method': request.method}
+        metrics.inc('library_requests_total', dict(route, status=str(response.status_code)))
+        metrics.observe('library_request_duration_seconds', route, elapsed)
+        metrics.observe('library_db_statements_per_request', route, g.sql_count, STATEMENT_BUCKETS)
+        metrics.observe('library_db_duration_seconds', route, g.sql_time)
+
+        threshold = app.config.get('SLOW_REQUEST_MS')
+        if threshold and elapsed * 1000 >= threshold:
+            statements = '\n'.join(f'  {seconds * 1000:8.2f}ms  {sql}' for seconds, sql in g.sql_log)
+            slow_log.warning('Slow request %s %s took %.1fms with %d SQL statements (%.1fms):\n%s',
+                             request.method, request.full_path, elapsed * 1000,
+                             g.sql_count, g.sql_time * 1000, statements)
+
+        cache = app.extensions.get('catalog_cache')
+        if cache is not None:
+            metrics.set_total('library_catalog_cache_hits_total', {}, cache.pages.hits)
+            metrics.set_total('library_catalog_cache_misses_total', {}, cache.pages.misses)
+            metrics.set_total('library_catalog_row_cache_hits_total', {}, cache.rows.hits)
+            metrics.set_total('library_catalog_row_cache_misses_total', {}, cache.rows.misses)
+        metrics.flush()
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -1,21 +1,134 @@
+from datetime import datetime, timezone
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def utcnow():
+    """Naive UTC timestamp, matching how DateTime columns are stored"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
-db = SQLAlchemy()
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(50), unique=True, nullable=False)
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
-    password = db.Column(db.String(100), nullable=False)
-    borrowed_books = db.Column(db.String(500), default="")
+    # scrypt hash, see passwords.py
+    password = db.Column(db.String(255), nullable=False)
 
     def __repr__(self):
         return f'<User {self.name}>'
     
 class Book(db.Model):
+    __table_args__ = (
+        # Duplicate detection on import looks books up by (title, author)
+        db.Index('ix_book_title_author', 'title', 'author'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(500), nullable=False)
     author = db.Column(db.String(100), nullable=False)
     available = db.Column(db.Boolean, default=True)
 
+
+class Loan(db.Model):
+    """One borrow of one book; returned_at stays NULL while the loan is active"""
+    __table_args__ = (
+        db.Index('ix_loan_user_returned', 'user_id', 'returned_at'),
+        # The overdue sweep walks open loans in due_at order: returned_at IS NULL
+        # is the equality prefix, so returned loans are never scanned
+        db.Index('ix_loan_open_due', 'returned_at', 'due_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False, index=True)
+    borrowed_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    returned_at = db.Column(db.DateTime)
+    due_at = db.Column(db.DateTime)
+    # Running late fee, recomputed by `flask sweep-overdue`
+    fine_cents = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    def __repr__(self):
+        return f'<Loan book={self.book_id} user={self.user_id}>'
+
+
+class Hold(db.Model):
+    """
+    A user's place in the queue for a book that is out. Tickets are handed
+    out per book in queue order and kept dense, so a position is just
+    ticket - HoldQueue.served, with no count over the queue.
+    """
+    __table_args__ = (
+        # The next holder is the lowest ticket for the book
+        db.Index('ix_hold_book_ticket', 'book_id', 'ticket'),
+        db.UniqueConstraint('book_id', 'user_id', name='uq_hold_book_user'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    ticket = db.Column(db.Integer, nullable=False)
+    queued_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+
+class HoldQueue(db.Model):
+    """Ticket counters for one book's holds: the last ticket issued and the last one served"""
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), primary_key=True,
+                        autoincrement=False)
+    issued = db.Column(db.Integer, nullable=False, default=0)
+    served = db.Column(db.Integer, nullable=False, default=0)
+
+
+class LoanEvent(db.Model):
+    """
+    Append-only log of borrows and returns, written in the loan transaction
+    and consumed by stats.fold_stats() into the *Stats tables below.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    borrowed = db.Column(db.Boolean, nullable=False)  # False for a return
+    at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+
+class BookStats(db.Model):
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), primary_key=True,
+                        autoincrement=False)
+    borrows = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+
+class AuthorStats(db.Model):
+    author = db.Column(db.String(100), primary_key=True)
+    borrows = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+
+class DailyStats(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    borrows = db.Column(db.Integer, nullable=False, default=0)
+    returns = db.Column(db.Integer, nullable=False, default=0)
+
+
+class UserStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True,
+                        autoincrement=False)
+    borrows = db.Column(db.Integer, nullable=False, default=0)
+    active_loans = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CatalogVersion(db.Model):
+    """
+    Single-row counter bumped in every transaction that changes the catalog.
+    Workers compare it against their cached copy instead of re-reading books.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+event.listen(CatalogVersion.__table__, 'after_create',
+             DDL('INSERT INTO catalog_version (id, version) VALUES (1, 0)'))
@@ -0,0 +1,148 @@
+"""
+Overdue loans: late fees and the schema change that introduced due dates.
+
+`flask sweep-overdue` walks the open loans that are past due in (due_at, id)
+order, one keyset page at a time, using ix_loan_open_due. Each page is read,
+priced and written back with a single executemany in its own short
+transaction, so a live borrow or return waits at most for one page and a
+sweep over millions of loans costs the same per page from start to finish.
+Only the loans whose fine actually changed are written, and a page that
+changes any also bumps the catalog version, which the /api/v1/me/loans ETag
+is built from. The cut-off is fixed when the sweep starts, so loans falling
+due while it runs wait for the next one.
+"""
+import time
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import bindparam
+
+from models import db, Loan, utcnow
+from cache import catalog_changed
+from loans import due_date
+from sqlite_mode import write_transaction
+
+ONE_DAY = timedelta(days=1)
+
+
+class SweepStats:
+    def __init__(self):
+        self.scanned = 0
+        self.fined = 0
+        self.newly_overdue = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        return (f'{self.scanned} overdue loans scanned, {self.fined} fines updated '
+                f'({self.newly_overdue} newly overdue) in {self.elapsed:.1f}s')
+
+
+def fine_for(due_at, now):
+    """Late fee in cents: FINE_PER_DAY_CENTS for every day started, capped at FINE_MAX_CENTS"""
+    days = -((due_at - now) // ONE_DAY)
+    config = current_app.config
+    return min(max(days, 0) * config.get('FINE_PER_DAY_CENTS', 25),
+               config.get('FINE_MAX_CENTS', 2000))
+
+
+def sweep_overdue(now=None, batch_size=1000, pause=0.0, progress=None):
+    """
+    Recompute the fine on every open loan that was due before `now`. `pause`
+    seconds are slept between pages to leave room for live writers.
+    """
+    now = now or utcnow()
+    stats = SweepStats()
+    loans = Loan.__table__
+    set_fine = (
+        db.update(loans)
+        .where(loans.c.id == bindparam('loan_id'), loans.c.returned_at.is_(None))
+        .values(fine_cents=bindparam('fine'))
+    )
+    after = None
+    while True:
+        with write_transaction():
+            page = _overdue_page(now, after, batch_size)
+            changed = []
+            for loan_id, due_at, fine_cents in page:
+                fine = fine_for(due_at, now)
+                if fine != fine_cents:
+                    changed.append({'loan_id': loan_id, 'fine': fine})
+                    stats.newly_overdue += fine_cents == 0
+            if changed:
+                db.session.execute(set_fine, changed)
+                catalog_changed()
+            db.session.commit()
+        stats.scanned += len(page)
+        stats.fined += len(changed)
+        if progress:
+            progress(stats)
+        if len(page) < batch_size:
+            return stats
+        after = page[-1][1], page[-1][0]
+        if pause:
+            time.sleep(pause)
+
+
+def _overdue_page(now, after, limit):
+    query = (
+        db.select(Loan.id, Loan.due_at, Loan.fine_cents)
+        .where(Loan.returned_at.is_(None), Loan.due_at < now)
+        .order_by(Loan.due_at, Loan.id)
+        .limit(limit)
+    )
+    if after is not None:
+        due_at, loan_id = after
+        # The >= gives the index a start point; the OR only breaks ties on id
+        query = query.where(Loan.due_at >= due_at,
+                            db.or_(Loan.due_at > due_at, Loan.id > loan_id))
+    return db.session.execute(query).all()
+
+
+def add_due_dates(batch_size=1000):
+    """
+    Bring a database created before due dates up to date: add the due_at and
+    fine_cents columns and their index if missing, then give open loans
+    without a due date one counted from when they were borrowed. Returns the
+    number of loans backfilled.
+    """
+    table = Loan.__table__
+    conn = db.session.connection()
+    columns = {col['name'] for col in db.inspect(conn).get_columns(table.name)}
+    for name in ('due_at', 'fine_cents'):
+        if name not in columns:
+            column = table.c[name]
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(conn.dialect)}'
+            if column.server_default is not None:
+                ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+            conn.exec_driver_sql(ddl)
+    for index in table.indexes:
+        index.create(conn, checkfirst=True)
+    db.session.commit()
+
+    set_due = (
+        db.update(table)
+        .where(table.c.id == bindparam('loan_id'))
+        .values(due_at=bindparam('due'))
+    )
+    backfilled, after = 0, 0
+    while True:
+        with write_transaction():
+            page = db.session.execute(
+                db.select(Loan.id, Loan.borrowed_at)
+                .where(Loan.returned_at.is_(None), Loan.due_at.is_(None), Loan.id > after)
+                .order_by(Loan.id)
+                .limit(batch_size)
+            ).all()
+            if page:
+                db.session.execute(set_due, [{'loan_id': loan_id, 'due': due_date(borrowed_at)}
+                                             for loan_id, borrowed_at in page])
+                catalog_changed()
+            db.session.commit()
+        backfilled += len(page)
+        if len(page) < batch_size:
+            return backfilled
+        after = page[-1][0]
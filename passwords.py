@@ -0,0 +1,232 @@
+"""
+Password hashing with stdlib scrypt.
+
+Hashes are stored as
+
+    $scrypt$ln=<log2 N>,r=<r>,p=<p>$<salt>$<hash>
+
+with salt and hash in unpadded base64. The parameters travel with the hash,
+so PASSWORD_SCRYPT_LN can be raised at deploy time: old hashes still verify,
+and a successful login rewrites any hash made with other parameters. Values
+that don't have exactly that shape are plaintext from before hashing (which
+may well start with '$') and get the same treatment (`flask hash-passwords`
+converts the rest in bulk). Accounts
+provisioned without a password hold UNUSABLE_PASSWORD, which never verifies.
+
+hashlib.scrypt releases the GIL, so hashing runs on a small per-process pool
+of PASSWORD_HASH_WORKERS threads while the worker's other threads keep
+serving pages. At most PASSWORD_HASH_QUEUE callers wait for that pool; past
+that HashingBusy is raised and the view answers 503 instead of letting a
+login burst tie up every request thread. Under gevent the pool is gevent's
+native thread pool, so waiting on a hash yields to other greenlets.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy.exc import OperationalError
+
+from models import db, User
+from sqlite_mode import write_transaction
+
+SCHEME = 'scrypt'
+SALT_BYTES = 16
+HASH_BYTES = 32
+UNUSABLE_PASSWORD = '!'
+HASH_FORMAT = re.compile(r'\$' + SCHEME + r'\$ln=(\d+),r=(\d+),p=(\d+)'
+                         r'\$([A-Za-z0-9+/]+)\$([A-Za-z0-9+/]+)')
+
+
+class HashingBusy(Exception):
+    """More logins are waiting for the hashing pool than PASSWORD_HASH_QUEUE allows"""
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode().rstrip('=')
+
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _scrypt(password, salt, ln, r, p):
+    n = 1 << ln
+    # hashlib refuses more than 32 MiB by default; scrypt needs about 128*r*N
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * (n + p) + (1 << 20), dklen=HASH_BYTES)
+
+
+def make_hash(password, ln=14, r=8, p=1, salt=None):
+    """Hash on the calling thread; the pool-backed PasswordHasher is what views use"""
+    salt = salt or os.urandom(SALT_BYTES)
+    digest = _scrypt(password, salt, ln, r, p)
+    return f'${SCHEME}$ln={ln},r={r},p={p}${_b64(salt)}${_b64(digest)}'
+
+
+def parse_hash(stored):
+    """(params dict, salt, digest) for a stored hash, or None for anything else (plaintext)"""
+    match = HASH_FORMAT.fullmatch(stored)
+    if match is None:
+        return None
+    ln, r, p, salt, digest = match.groups()
+    try:
+        salt, digest = _unb64(salt), _unb64(digest)
+    except ValueError:
+        return None
+    if len(digest) != HASH_BYTES:
+        return None
+    return {'ln': int(ln), 'r': int(r), 'p': int(p)}, salt, digest
+
+
+def _check(stored, password):
+    parsed = parse_hash(stored)
+    if parsed is None:
+        return hmac.compare_digest(stored.encode(), password.encode())
+    params, salt, digest = parsed
+    return hmac.compare_digest(_scrypt(password, salt, params['ln'], params['r'], params['p']),
+                               digest)
+
+
+def _make_pool(workers):
+    try:
+        from gevent import monkey
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+    except ImportError:
+        NativeThreadPoolExecutor = None
+    if NativeThreadPoolExecutor and monkey.is_module_patched('threading'):
+        return NativeThreadPoolExecutor(workers)
+    return ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+
+
+class PasswordHasher:
+    def __init__(self, ln=14, r=8, p=1, workers=2, queue=32):
+        self.params = {'ln': ln, 'r': r, 'p': p}
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        self._dummy = None
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            return self._executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def _executor(self):
+        # Threads don't survive fork, so each worker builds its own pool
+        if self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool_pid != os.getpid():
+                    self._pool = _make_pool(self.workers)
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def hash(self, password):
+        params = self.params
+        return self._submit(make_hash, password, params['ln'], params['r'], params['p'])
+
+    def verify(self, stored, password):
+        if stored is None or stored == UNUSABLE_PASSWORD:
+            # Unknown account: spend the same time so response times don't reveal it
+            self._dummy = self._dummy or self.hash('')
+            self._submit(_check, self._dummy, password)
+            return False
+        return self._submit(_check, stored, password)
+
+    def needs_rehash(self, stored):
+        parsed = parse_hash(stored)
+        return parsed is None or parsed[0] != self.params
+
+
+def get_hasher(app=None):
+    return (app or current_app).extensions['passwords']
+
+
+def init_passwords(app):
+    app.extensions['passwords'] = PasswordHasher(
+        app.config.get('PASSWORD_SCRYPT_LN', 14),
+        app.config.get('PASSWORD_SCRYPT_R', 8),
+        app.config.get('PASSWORD_SCRYPT_P', 1),
+        app.config.get('PASSWORD_HASH_WORKERS', 2),
+        app.config.get('PASSWORD_HASH_QUEUE', 32),
+    )
+
+
+def hash_password(password):
+    return get_hasher().hash(password)
+
+
+def verify_password(stored, password):
+    """True if the password matches the stored hash (or legacy plaintext); stored may be None"""
+    return get_hasher().verify(stored, password)
+
+
+def upgrade_password(user, password):
+    """
+    After a successful login, rewrite a hash made with other parameters (or
+    plaintext). Skipped if the pool is busy, the database is locked, or the
+    password changed meanwhile; the next login tries again.
+    """
+    hasher = get_hasher()
+    user_id, old = user.id, user.password
+    if not hasher.needs_rehash(old):
+        return False
+    # End the login's read transaction so no snapshot is held while hashing
+    db.session.rollback()
+    try:
+        new = hasher.hash(password)
+    except HashingBusy:
+        return False
+    try:
+        with write_transaction():
+            updated = db.session.execute(
+                db.update(User).where(User.id == user_id, User.password == old)
+                .values(password=new)
+            ).rowcount
+            db.session.commit()
+    except OperationalError:
+        return False
+    return updated == 1
+
+
+def hash_plaintext_passwords(batch_size=500):
+    """Hash every remaining plaintext password; returns how many were converted"""
+    params = get_hasher().params
+    users = User.__table__
+    set_password = (
+        db.update(users)
+        .where(users.c.id == db.bindparam('user'), users.c.password == db.bindparam('old'))
+        .values(password=db.bindparam('new'))
+    )
+    converted, after = 0, 0
+    while True:
+        # Plaintext can look like anything, so every row is read and parse_hash()
+        # decides, exactly as a login would
+        rows = db.session.execute(
+            db.select(User.id, User.password)
+            .where(User.id > after, User.password != UNUSABLE_PASSWORD)
+            .order_by(User.id)
+            .limit(batch_size)
+        ).all()
+        # Hash with no transaction open; the guarded UPDATE skips any row
+        # whose password changed in the meantime
+        db.session.rollback()
+        plaintext = [{'user': user_id, 'old': old, 'new': make_hash(old, **params)}
+                     for user_id, old in rows if parse_hash(old) is None]
+        if plaintext:
+            with write_transaction():
+                db.session.execute(set_password, plaintext)
+                db.session.commit()
+        converted += len(plaintext)
+        if len(rows) < batch_size:
+            return converted
+        after = rows[-1][0]
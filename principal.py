@@ -0,0 +1,82 @@
+"""
+The logged-in user's loans, cached in the signed session cookie.
+
+/books needs the ids of the books the user holds, and their places in hold
+queues, on every request. Instead of querying for them each time, they are
+kept in the session together with the catalog version they were read at.
+The catalog version is read for the page cache anyway, so while it is
+unchanged the loans cost no query at all. Borrowing, returning and holds
+through the views update the cached entry in place; any other change to the
+catalog (including a promotion from someone else's return) makes the next
+request re-read it.
+
+Browsers drop cookies over about 4KB, which would log the user out, so the
+entry is only kept while the user has at most SESSION_LOANS_MAX loans and
+holds. Above that they are read from the database once per request.
+"""
+from flask import current_app, g, session
+
+from cache import catalog_version
+from loans import loans_and_holds
+
+
+def current_loan_ids():
+    """Book ids the logged-in user has on loan"""
+    return set(_current()['ids'])
+
+
+def current_holds():
+    """{book_id: queue position} for the logged-in user's holds"""
+    return dict(_current()['holds'])
+
+
+def loan_changed(borrowed=(), returned=(), holds=None):
+    """
+    Record the books the user just borrowed and returned, and holds placed
+    ({book_id: position}) or cancelled ({book_id: None}), in one commit. The
+    cached entry is only patched if no one else changed the catalog since it
+    was read, i.e. our commit was the only bump; otherwise it is dropped.
+    """
+    user_id = session['user_id']
+    version = catalog_version()
+    cached = session.get('loans')
+    g.pop('loans', None)
+    if not cached or cached['user'] != user_id or cached['version'] != version - 1:
+        session.pop('loans', None)
+        return
+    ids = (set(cached['ids']) - set(returned)) | set(borrowed)
+    held = dict(cached['holds'])
+    for book_id, position in (holds or {}).items():
+        if position is None:
+            held.pop(book_id, None)
+        else:
+            held[book_id] = position
+    _remember(user_id, ids, held, version)
+
+
+def forget_principal():
+    session.pop('loans', None)
+    g.pop('loans', None)
+
+
+def _current():
+    user_id = session['user_id']
+    version = catalog_version()
+    # g.loans spares a second query in the same request when the session can't hold them
+    for cached in (session.get('loans'), g.get('loans')):
+        if cached and cached['user'] == user_id and cached['version'] == version:
+            return cached
+    ids, held = loans_and_holds(user_id)
+    g.loans = _remember(user_id, ids, held, version)
+    return g.loans
+
+
+def _remember(user_id, ids, held, version):
+    # Pairs rather than a dict: JSON would turn the book ids into strings
+    entry = {'user': user_id, 'version': version, 'ids': sorted(ids),
+             'holds': sorted(held.items())}
+    if len(entry['ids']) + len(entry['holds']) <= current_app.config.get('SESSION_LOANS_MAX', 64):
+        session['loans'] = entry
+    else:
+        session.pop('loans', None)
+    return entry
@@ -0,0 +1,281 @@
+"""
+Rate limits on login and registration attempts, shared by every worker.
+
+Each limit is a token bucket ("10/minute" allows a burst of 10, refilled at
+one every six seconds) kept as GCRA: a single timestamp per key, the time at
+which the bucket will be full again. Each attempt pushes that moment one
+interval further and is allowed if it stays within a period of now. One
+float per key makes the state cheap to share:
+
+    memory://                   this process only (tests, single worker)
+    mmap:///tmp/library-rl      a fixed table of 16-byte slots in a
+                                memory-mapped file; workers on one host
+                                share it under flock, a few microseconds a hit
+    sqlite:///tmp/library-rl.db a table in its own SQLite file
+    redis://host:6379/0         one Lua script per hit, for several hosts
+
+RATELIMIT_STORAGE_URI picks the store. Every store has the same hit() method,
+so adding another is one class and a branch in open_store().
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+
+from flask import current_app, request
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class RateLimited(Exception):
+    """Too many attempts; retry_after is the whole number of seconds to wait"""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def parse_limit(text):
+    """'10/minute' or '10/90' (seconds) -> (interval, period) in seconds, None if unset"""
+    if not text:
+        return None
+    count, _, period = text.partition('/')
+    period = PERIODS.get(period.strip().rstrip('s'), None) or float(period)
+    # A full bucket takes `count` back-to-back hits, the last bringing tat a period ahead
+    return period / int(count), period
+
+
+def _gcra(tat, now, interval, tolerance):
+    """(new tat or None if denied, seconds to wait) for a bucket that is full again at tat"""
+    new_tat = max(tat, now) + interval
+    wait = new_tat - tolerance - now
+    if wait > 1e-9:  # summed intervals may overshoot the period by a rounding error
+        return None, wait
+    return new_tat, 0.0
+
+
+class MemoryStore:
+    """Buckets in a dict, for one process"""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._tats = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, now, interval, tolerance):
+        with self._lock:
+            new_tat, wait = _gcra(self._tats.get(key, 0.0), now, interval, tolerance)
+            if new_tat is not None:
+                if len(self._tats) >= self.max_keys and key not in self._tats:
+                    # A full bucket is the same as no entry
+                    self._tats = {k: t for k, t in self._tats.items() if t > now}
+                self._tats[key] = new_tat
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._tats.clear()
+
+
+def _key_hash(key):
+    # Python's hash() is salted per process; workers need the same slot
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+
+class MmapStore:
+    """
+    Buckets in a memory-mapped file of `slots` (key hash, tat) pairs, looked
+    up by open addressing over PROBES slots. When all of them hold live
+    buckets the one closest to full is dropped, so memory stays fixed and an
+    eviction can only ever forgive, never block, a key.
+    """
+
+    SLOT = struct.Struct('Qd')
+    PROBES = 8
+
+    def __init__(self, path, slots=4096):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        # flock is per open file: each worker needs its own descriptor, not the master's
+        if self._pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            size = self.slots * self.SLOT.size
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._fd = fd
+            self._map = mmap.mmap(fd, size)
+            self._pid = os.getpid()
+
+    def hit(self, key, now, interval, tolerance):
+        h = _key_hash(key)
+        slot_size, unpack = self.SLOT.size, self.SLOT.unpack_from
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                found = free = oldest = None
+                oldest_tat = math.inf
+                for i in range(self.PROBES):
+                    offset = (h + i) % self.slots * slot_size
+                    slot_hash, tat = unpack(self._map, offset)
+                    if slot_hash == h:
+                        found = offset
+                        break
+                    if slot_hash == 0:
+                        # Slots are never emptied, so the key can't be further on
+                        free = offset if free is None else free
+                        break
+                    if free is None and tat <= now:
+                        free = offset
+                    elif tat < oldest_tat:
+                        oldest, oldest_tat = offset, tat
+                if found is not None:
+                    tat = unpack(self._map, found)[1]
+                else:
+                    found, tat = (free if free is not None else oldest), 0.0
+                new_tat, wait = _gcra(tat, now, interval, tolerance)
+                if new_tat is not None:
+                    self.SLOT.pack_into(self._map, found, h, new_tat)
+                return wait
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def clear(self):
+        with self._lock:
+            self._open()
+            self._map[:] = bytes(len(self._map))
+
+
+class SQLiteStore:
+    """Buckets in a table of their own SQLite file, one short IMMEDIATE transaction a hit"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._hits = 0
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')  # limiter state is not worth an fsync
+            conn.execute('CREATE TABLE IF NOT EXISTS rate_limit '
+                         '(key TEXT PRIMARY KEY, tat REAL NOT NULL) WITHOUT ROWID')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def hit(self, key, now, interval, tolerance):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tat FROM rate_limit WHERE key = ?', (key,)).fetchone()
+            new_tat, wait = _gcra(row[0] if row else 0.0, now, interval, tolerance)
+            if new_tat is not None:
+                conn.execute('INSERT INTO rate_limit (key, tat) VALUES (?, ?) '
+                             'ON CONFLICT (key) DO UPDATE SET tat = excluded.tat',
+                             (key, new_tat))
+            self._hits += 1
+            if self._hits % 1000 == 0:
+                conn.execute('DELETE FROM rate_limit WHERE tat <= ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+    def clear(self):
+        self._connection().execute('DELETE FROM rate_limit')
+
+
+class RedisStore:
+    """Buckets as Redis keys that expire once full; the check-and-set is one Lua call"""
+
+    # Lua numbers come back as integers, so the wait travels as a string
+    SCRIPT = """
+    local now, interval, tolerance = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), now) + interval
+    local wait = tat - tolerance - now
+    if wait > 1e-9 then return tostring(wait) end
+    redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now) * 1000))
+    return '0'
+    """
+
+    def __init__(self, url, prefix='ratelimit:'):
+        import redis  # only needed for this store
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def hit(self, key, now, interval, tolerance):
+        return float(self._script(keys=[self.prefix + key], args=[now, interval, tolerance]))
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + '*'):
+            self._client.delete(key)
+
+
+def open_store(uri, slots=4096):
+    parts = urlsplit(uri)
+    if parts.scheme == 'memory':
+        return MemoryStore()
+    if parts.scheme == 'mmap':
+        return MmapStore(parts.path, slots)
+    if parts.scheme == 'sqlite':
+        return SQLiteStore(parts.path)
+    if parts.scheme in ('redis', 'rediss', 'unix'):
+        return RedisStore(uri)
+    raise ValueError(f'unknown rate limit storage {uri!r}')
+
+
+class RateLimiter:
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = {name: parse_limit(text) for name, text in limits.items()}
+
+    def hit(self, name, value, now=None):
+        """Count an attempt against limit `name` for `value`; raises RateLimited when over"""
+        limit = self.limits.get(name)
+        if limit is None or not value:
+            return
+        wait = self.store.hit(f'{name}:{value}', now or time.time(), *limit)
+        if wait:
+            raise RateLimited(wait)
+
+
+def init_ratelimit(app):
+    config = app.config
+    limiter = None
+    if config.get('RATELIMIT_ENABLED', True):
+        store = open_store(config.get('RATELIMIT_STORAGE_URI', 'memory://'),
+                           config.get('RATELIMIT_SLOTS', 4096))
+        limiter = RateLimiter(store, {
+            'login-ip': config.get('RATELIMIT_LOGIN_IP'),
+            'login-email': config.get('RATELIMIT_LOGIN_EMAIL'),
+            'register-ip': config.get('RATELIMIT_REGISTER_IP'),
+            'register-email': config.get('RATELIMIT_REGISTER_EMAIL'),
+        })
+    app.extensions['ratelimit'] = limiter
+
+
+def get_limiter(app=None):
+    return (app or current_app).extensions['ratelimit']
+
+
+def check_rate_limit(action, email):
+    """Count a login or register attempt by client address and by email"""
+    limiter = get_limiter()
+    if limiter is None:
+        return
+    limiter.hit(f'{action}-ip', request.remote_addr)
+    limiter.hit(f'{action}-email', email.strip().lower())
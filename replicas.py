@@ -0,0 +1,78 @@
+"""
+Read-replica routing.
+
+SQLALCHEMY_REPLICA_URIS lists read-only copies of the primary database. Each
+gets an engine with the same SQLALCHEMY_ENGINE_OPTIONS as the primary; they
+are not binds, since no model lives only there and create_all must skip them.
+
+Inside replica_reads(), plain SELECTs issued through db.session go to one
+replica, picked at random and kept for the rest of the session. Everything
+else goes to the primary: writes, flushes, raw SQL, and every statement after
+the session has written something. Once a request writes, the browser session
+is pinned to the primary for REPLICA_LAG_SECONDS, so the next page shows the
+user's own change even if the replica hasn't caught up yet.
+"""
+import random
+import time
+from contextlib import contextmanager
+
+from flask import current_app, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+from sqlalchemy.sql import Select
+
+
+class RoutingSession(Session):
+    """db.session class that can send reads to a replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if isinstance(clause, Select) and not self._flushing:
+                if self.info.get('replica_reads') and not self.info.get('wrote'):
+                    replica = self._replica()
+                    if replica is not None:
+                        return replica
+            elif clause is not None or self._flushing:
+                self.info['wrote'] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _replica(self):
+        if 'replica' not in self.info:
+            replicas = replica_engines()
+            self.info['replica'] = random.choice(replicas) if replicas else None
+        return self.info['replica']
+
+
+def replica_engines(app=None):
+    return (app or current_app).extensions.get('replica_engines', [])
+
+
+def init_replicas(app):
+    """Create an engine per replica URI"""
+    uris = app.config['SQLALCHEMY_REPLICA_URIS']
+    if not uris:
+        return
+    options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    app.extensions['replica_engines'] = [create_engine(uri, **options) for uri in uris]
+
+    @app.after_request
+    def pin_writers_to_primary(response):
+        db = app.extensions['sqlalchemy']
+        if db.session().info.get('wrote'):
+            session['primary_until'] = time.time() + app.config['REPLICA_LAG_SECONDS']
+        return response
+
+
+@contextmanager
+def replica_reads():
+    """Let the SELECTs in the block read from a replica"""
+    db_session = current_app.extensions['sqlalchemy'].session()
+    if session.get('primary_until', 0) > time.time():
+        yield
+        return
+    previous = db_session.info.get('replica_reads', False)
+    db_session.info['replica_reads'] = True
+    try:
+        yield
+    finally:
+        db_session.info['replica_reads'] = previous
@@ -0,0 +1,139 @@
+"""
+Pluggable search backends for the /books `q` filter.
+
+- like:     the original ILIKE substring scan, works everywhere
+- fts5:     SQLite FTS5 external-content table kept in sync by triggers
+- fulltext: MySQL InnoDB FULLTEXT index on (title, author)
+
+Pick one with the SEARCH_BACKEND setting; 'auto' chooses by database dialect.
+"""
+import re
+from abc import ABC, abstractmethod
+
+from flask import current_app
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.mysql import match
+
+from models import db, Book
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# InnoDB ignores shorter tokens unless innodb_ft_min_token_size is lowered
+MYSQL_MIN_TOKEN = 3
+
+SQLITE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5("
+    "title, author, content='book', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS book_fts_ai AFTER INSERT ON book BEGIN "
+    "INSERT INTO book_fts(rowid, title, author) VALUES (new.id, new.title, new.author); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS book_fts_ad AFTER DELETE ON book BEGIN "
+    "INSERT INTO book_fts(book_fts, rowid, title, author) "
+    "VALUES ('delete', old.id, old.title, old.author); "
+    "END",
+    # Only title/author changes touch the index, availability flips don't
+    "CREATE TRIGGER IF NOT EXISTS book_fts_au AFTER UPDATE OF title, author ON book BEGIN "
+    "INSERT INTO book_fts(book_fts, rowid, title, author) "
+    "VALUES ('delete', old.id, old.title, old.author); "
+    "INSERT INTO book_fts(rowid, title, author) VALUES (new.id, new.title, new.author); "
+    "END",
+]
+MYSQL_FULLTEXT_DDL = "ALTER TABLE book ADD FULLTEXT INDEX ix_book_fulltext (title, author)"
+
+for statement in SQLITE_FTS_DDL:
+    event.listen(Book.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Book.__table__, 'after_drop',
+             DDL('DROP TABLE IF EXISTS book_fts').execute_if(dialect='sqlite'))
+event.listen(Book.__table__, 'after_create',
+             DDL(MYSQL_FULLTEXT_DDL).execute_if(dialect='mysql'))
+
+
+def tokenize(q):
+    return TOKEN_RE.findall(q.lower())
+
+
+class SearchBackend(ABC):
+    """
+    Backends implement ranked(q) -> (select of Book, rank expression or None).
+    Lower rank sorts first; ties and unranked results fall back to Book.id.
+    """
+    name = None
+
+    @abstractmethod
+    def ranked(self, q):
+        """Return (select of Book, rank expression or None) for the query"""
+
+    def search(self, q):
+        stmt, rank = self.ranked(q)
+        if rank is None:
+            return stmt.order_by(Book.id)
+        return stmt.order_by(rank, Book.id)
+
+
+class LikeSearch(SearchBackend):
+    """Substring match on title or author; no index can serve it"""
+    name = 'like'
+
+    def ranked(self, q):
+        like = f"%{q}%"
+        return db.select(Book).where(Book.title.ilike(like) | Book.author.ilike(like)), None
+
+
+class SQLiteFTSSearch(SearchBackend):
+    """Token-prefix match through FTS5, ranked by bm25"""
+    name = 'fts5'
+
+    book_fts = db.table('book_fts', db.column('rowid'), db.column('rank'), db.column('book_fts'))
+
+    def ranked(self, q):
+        terms = tokenize(q)
+        if not terms:
+            return LikeSearch().ranked(q)
+        # Quote every term so user input can't inject FTS query syntax
+        expression = ' '.join(f'"{term}"*' for term in terms)
+        fts = self.book_fts
+        stmt = (db.select(Book)
+                .join(fts, fts.c.rowid == Book.id)
+                .where(fts.c.book_fts.op('MATCH')(expression)))
+        return stmt, fts.c.rank
+
+
+class MySQLFullTextSearch(SearchBackend):
+    """Boolean-mode MATCH ... AGAINST on the FULLTEXT index, best score first"""
+    name = 'fulltext'
+
+    def ranked(self, q):
+        terms = [term for term in tokenize(q) if len(term) >= MYSQL_MIN_TOKEN]
+        if not terms:
+            return LikeSearch().ranked(q)
+        score = match(Book.title, Book.author,
+                      against=' '.join(f'+{term}*' for term in terms)).in_boolean_mode()
+        return db.select(Book).where(score > 0), -score
+
+
+BACKENDS = {backend.name: backend for backend in (LikeSearch, SQLiteFTSSearch, MySQLFullTextSearch)}
+DIALECT_DEFAULTS = {'sqlite': 'fts5', 'mysql': 'fulltext'}
+
+
+def get_search_backend():
+    """Return the backend configured by SEARCH_BACKEND for the current app"""
+    name = current_app.config.get('SEARCH_BACKEND', 'auto')
+    if name == 'auto':
+        name = DIALECT_DEFAULTS.get(db.engine.dialect.name, 'like')
+    return BACKENDS[name]()
+
+
+def rebuild_search_index():
+    """Create the search index on an existing database and (re)populate it"""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        for statement in SQLITE_FTS_DDL:
+            db.session.execute(db.text(statement))
+        db.session.execute(db.text("INSERT INTO book_fts(book_fts) VALUES ('rebuild')"))
+    elif dialect == 'mysql':
+        indexes = {ix['name'] for ix in db.inspect(db.engine).get_indexes('book')}
+        if 'ix_book_fulltext' not in indexes:
+            db.session.execute(db.text(MYSQL_FULLTEXT_DDL))
+    db.session.commit()
+    return dialect
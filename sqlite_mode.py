@@ -0,0 +1,140 @@
+"""
+Production settings for SQLite.
+
+Every new connection is switched to WAL (readers never wait for the writer),
+synchronous=NORMAL, a busy_timeout, memory-mapped I/O and a bigger page cache,
+from the SQLITE_* settings in config.py.
+
+pysqlite's own BEGIN handling is turned off so we can emit BEGIN ourselves:
+plain transactions get a deferred BEGIN, while write_transaction() starts with
+BEGIN IMMEDIATE. A writer therefore takes the write lock before it reads
+anything, instead of upgrading a read snapshot mid-transaction, which fails
+with SQLITE_BUSY_SNAPSHOT and cannot be waited out. Writers in one process
+queue on a lock and writers in other gunicorn workers on an flock of
+<database>-write.lock, so short borrow/return transactions run one after the
+other instead of spinning in the busy handler. The flock is polled without
+blocking, so under gevent a waiting writer sleeps cooperatively instead of
+stalling every other greenlet in the worker.
+"""
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from flask import current_app
+from sqlalchemy import event
+
+from models import db
+from replicas import replica_engines
+
+
+class WriteLock:
+    """Serializes write transactions across threads and, with a path, processes"""
+
+    MAX_POLL_INTERVAL = 0.01
+
+    def __init__(self, path=None):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        if self.path:
+            if self._pid != os.getpid():
+                # flock is per open file, so a forked worker needs its own
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._pid = os.getpid()
+            delay = 0.0005
+            while True:
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(delay)  # gevent-patched: yields to other greenlets
+                    delay = min(delay * 2, self.MAX_POLL_INTERVAL)
+
+    def release(self):
+        if self.path:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def pragmas(config):
+    return [
+        ('journal_mode', config['SQLITE_JOURNAL_MODE']),
+        ('synchronous', config['SQLITE_SYNCHRONOUS']),
+        ('busy_timeout', int(config['SQLITE_BUSY_TIMEOUT_MS'])),
+        ('mmap_size', int(config['SQLITE_MMAP_SIZE'])),
+        ('cache_size', int(config['SQLITE_CACHE_SIZE'])),
+    ]
+
+
+def configure_engine(engine, config, on_disk):
+    settings = pragmas(config)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in settings:
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+        if on_disk:
+            dbapi_connection.isolation_level = None  # we emit BEGIN in on_begin
+
+    if not on_disk:
+        # :memory: shares one connection between sessions; leave BEGIN to pysqlite
+        return
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(conn):
+        if conn.get_execution_options().get('sqlite_immediate'):
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+        else:
+            conn.exec_driver_sql('BEGIN')
+
+
+def init_sqlite(app):
+    """Apply the SQLite settings to the app's SQLite engines (replicas included)"""
+    if not app.config['SQLITE_TUNING']:
+        return
+    with app.app_context():
+        engines = list(db.engines.items())
+    engines += [('replica', engine) for engine in replica_engines(app)]
+    for bind_key, engine in engines:
+        if engine.dialect.name != 'sqlite':
+            continue
+        path = engine.url.database
+        on_disk = bool(path) and path != ':memory:' and not path.startswith('file:')
+        configure_engine(engine, app.config, on_disk)
+        if bind_key is None and on_disk:
+            lock_path = f'{path}-write.lock' if app.config['SQLITE_WRITE_LOCK'] else None
+            app.extensions['sqlite_write_lock'] = WriteLock(lock_path)
+
+
+@contextmanager
+def write_transaction():
+    """
+    Run the block as the only writer. The block is expected to commit or roll
+    back itself; if it raises, the transaction is rolled back here. For other
+    databases (and SQLite :memory:) only the rollback applies.
+    """
+    lock = current_app.extensions.get('sqlite_write_lock')
+    with lock or nullcontext():
+        session = db.session()
+        if lock is not None and not session.in_transaction():
+            session.connection(execution_options={'sqlite_immediate': True})
+        try:
+            yield
+        except BaseException:
+            session.rollback()
+            raise
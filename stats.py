@@ -0,0 +1,237 @@
+"""
+Circulation statistics kept as counters instead of GROUP BY over loans.
+
+Every borrow and return appends a LoanEvent row in its own transaction. That
+is one INSERT touching no shared row, so borrowers never queue behind a hot
+"today" counter. `flask fold-stats`, run every minute or so, consumes the log
+in batches: it deletes a batch of events, checks that it deleted all of them
+(otherwise a concurrent fold got there first and it backs off), and adds
+their counts to BookStats, AuthorStats, DailyStats and UserStats in the same
+transaction. Consuming by delete rather than keeping a high-water mark means
+an event that commits late with a lower id is still picked up next time.
+
+The counter tables are small and indexed, so the most-borrowed lists are a
+LIMIT over an index however many loans there are. `flask rebuild-stats`
+recomputes them from the loan table, and with --check only reports the rows
+that have drifted, writing nothing: events not yet folded are added to the
+counters in memory before comparing.
+"""
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+
+from models import db, AuthorStats, Book, BookStats, DailyStats, Loan, LoanEvent, UserStats, utcnow
+from sqlite_mode import write_transaction
+
+
+def record_loan_events(events, at=None):
+    """Log (book_id, user_id, borrowed) tuples; call inside the loan transaction"""
+    at = at or utcnow()
+    db.session.execute(db.insert(LoanEvent), [
+        {'book_id': book_id, 'user_id': user_id, 'borrowed': borrowed, 'at': at}
+        for book_id, user_id, borrowed in events
+    ])
+
+
+def fold_stats(batch_size=1000):
+    """Fold logged events into the counters; returns how many were folded"""
+    events_table = LoanEvent.__table__
+    folded = 0
+    while True:
+        with write_transaction():
+            events = _logged_events(batch_size)
+            if not events:
+                db.session.rollback()
+                return folded
+            ids = [e.id for e in events]
+            deleted = db.session.execute(
+                db.delete(events_table).where(events_table.c.id.in_(ids))
+            ).rowcount
+            if deleted != len(ids):
+                db.session.rollback()  # another fold is consuming these events
+                continue
+            try:
+                _add(_count(events))
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()  # raced another fold inserting the same new key
+                continue
+        folded += len(events)
+        if len(events) < batch_size:
+            return folded
+
+
+def _logged_events(limit=None):
+    query = (
+        db.select(LoanEvent.id, LoanEvent.book_id, LoanEvent.user_id,
+                  LoanEvent.borrowed, LoanEvent.at, Book.author)
+        .outerjoin(Book, Book.id == LoanEvent.book_id)
+        .order_by(LoanEvent.id)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    return db.session.execute(query).all()
+
+
+def _count(events):
+    books, authors = Counter(), Counter()
+    days = defaultdict(lambda: {'borrows': 0, 'returns': 0})
+    users = defaultdict(lambda: {'borrows': 0, 'active_loans': 0})
+    for e in events:
+        day = days[e.at.date()]
+        user = users[e.user_id]
+        if e.borrowed:
+            books[e.book_id] += 1
+            if e.author is not None:
+                authors[e.author] += 1
+            day['borrows'] += 1
+            user['borrows'] += 1
+            user['active_loans'] += 1
+        else:
+            day['returns'] += 1
+            user['active_loans'] -= 1
+    return {
+        BookStats: {key: {'borrows': n} for key, n in books.items()},
+        AuthorStats: {key: {'borrows': n} for key, n in authors.items()},
+        DailyStats: dict(days),
+        UserStats: dict(users),
+    }
+
+
+def _add(deltas_by_model):
+    """Add {key: {column: delta}} to each counter table, inserting missing keys"""
+    for model, deltas in deltas_by_model.items():
+        if not deltas:
+            continue
+        table = model.__table__
+        key = next(iter(table.primary_key.columns))
+        columns = list(next(iter(deltas.values())))
+        existing = set(db.session.scalars(db.select(key).where(key.in_(list(deltas)))))
+        updates = [{'key_': k, **{f'd_{c}': d[c] for c in columns}}
+                   for k, d in deltas.items() if k in existing]
+        inserts = [{key.name: k, **d} for k, d in deltas.items() if k not in existing]
+        if updates:
+            db.session.execute(
+                db.update(table).where(key == bindparam('key_'))
+                .values({c: table.c[c] + bindparam(f'd_{c}') for c in columns}),
+                updates,
+            )
+        if inserts:
+            db.session.execute(db.insert(table), inserts)
+
+
+def _day(value):
+    # SQLite's date() returns text
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _from_loans():
+    borrows = db.session.execute(
+        db.select(Loan.book_id, Book.author, Loan.user_id, db.func.date(Loan.borrowed_at),
+                  db.func.count(), db.func.count(Loan.returned_at))
+        .join(Book, Book.id == Loan.book_id)
+        .group_by(Loan.book_id, Book.author, Loan.user_id, db.func.date(Loan.borrowed_at))
+    ).all()
+    returns = db.session.execute(
+        db.select(db.func.date(Loan.returned_at), db.func.count())
+        .where(Loan.returned_at.is_not(None))
+        .group_by(db.func.date(Loan.returned_at))
+    ).all()
+    books, authors = Counter(), Counter()
+    days = defaultdict(lambda: {'borrows': 0, 'returns': 0})
+    users = defaultdict(lambda: {'borrows': 0, 'active_loans': 0})
+    for book_id, author, user_id, day, n, returned in borrows:
+        books[book_id] += n
+        authors[author] += n
+        days[_day(day)]['borrows'] += n
+        users[user_id]['borrows'] += n
+        users[user_id]['active_loans'] += n - returned
+    for day, n in returns:
+        days[_day(day)]['returns'] += n
+    return {
+        BookStats: {key: {'borrows': n} for key, n in books.items()},
+        AuthorStats: {key: {'borrows': n} for key, n in authors.items()},
+        DailyStats: dict(days),
+        UserStats: dict(users),
+    }
+
+
+def _drift(fresh, pending):
+    """{table name: keys whose counters, plus pending event deltas, differ from fresh}"""
+    drift = {}
+    for model, expected in fresh.items():
+        table = model.__table__
+        key = next(iter(table.primary_key.columns))
+        columns = [c for c in table.columns if c is not key]
+        zero = dict.fromkeys((c.name for c in columns), 0)
+        current = {row[0]: dict(zip((c.name for c in columns), row[1:]))
+                   for row in db.session.execute(db.select(key, *columns))}
+        for k, deltas in pending.get(model, {}).items():
+            counts = current.setdefault(k, dict(zero))
+            for column, delta in deltas.items():
+                counts[column] += delta
+        keys = set(current) | set(expected)
+        drift[table.name] = sum(current.get(k, zero) != expected.get(k, zero) for k in keys)
+    return drift
+
+
+def rebuild_stats(check=False, batch_size=1000):
+    """
+    Recompute every counter from the loan table with GROUP BY, which is heavy:
+    run it off-peak. Returns {table name: number of keys whose counts
+    differed}. With check=True nothing is written, not even a fold.
+    """
+    if check:
+        try:
+            # One read transaction, so the log and the loans are the same snapshot
+            pending = _count(_logged_events())
+            return _drift(_from_loans(), pending)
+        finally:
+            db.session.rollback()
+    fold_stats(batch_size)
+    with write_transaction():
+        # The events visible to this snapshot are the ones the loans below
+        # reflect; ones committed after it (on MySQL, possibly with lower
+        # ids) are left for the next fold
+        seen = db.session.scalars(db.select(LoanEvent.id)).all()
+        fresh = _from_loans()
+        drift = _drift(fresh, {})
+        events = LoanEvent.__table__
+        for start in range(0, len(seen), batch_size):
+            db.session.execute(
+                db.delete(events).where(events.c.id.in_(seen[start:start + batch_size])))
+        for model, expected in fresh.items():
+            db.session.execute(db.delete(model.__table__))
+            key = next(iter(model.__table__.primary_key.columns)).name
+            if expected:
+                db.session.execute(db.insert(model.__table__),
+                                   [{key: k, **counts} for k, counts in expected.items()])
+        db.session.commit()
+    return drift
+
+
+def most_borrowed(limit=10):
+    """[(book, borrows)] for the most borrowed books, read off the borrows index"""
+    return db.session.execute(
+        db.select(Book, BookStats.borrows)
+        .join(BookStats, BookStats.book_id == Book.id)
+        .order_by(BookStats.borrows.desc(), BookStats.book_id.desc())
+        .limit(limit)
+    ).all()
+
+
+def top_authors(limit=10):
+    return db.session.execute(
+        db.select(AuthorStats.author, AuthorStats.borrows)
+        .order_by(AuthorStats.borrows.desc(), AuthorStats.author.desc())
+        .limit(limit)
+    ).all()
+
+
+def recent_days(days=14):
+    since = utcnow().date() - timedelta(days=days - 1)
+    return db.session.scalars(
+        db.select(DailyStats).where(DailyStats.day >= since).order_by(DailyStats.day.desc())
+    ).all()
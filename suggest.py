@@ -0,0 +1,150 @@
+"""
+In-memory prefix index for search-box suggestions.
+
+Every title and author token is kept once, interned, in a sorted list, with
+how many books use it in a parallel array('I'). A prefix lookup is a bisect
+into that list followed by a scan of at most SCAN_LIMIT neighbours, picking
+the most used tokens; one- and two-letter prefixes, whose ranges can be huge,
+have their top tokens precomputed. Memory is one string per distinct token
+plus four bytes of count, whatever the number of books.
+
+Counts only ever grow, so when books are added a prefix's top tokens can only
+change to include tokens those books used. Only the short prefixes of those
+tokens are re-ranked, each among its current top and the changed tokens, so
+a catch-up costs time in the size of the new books rather than the index.
+
+Each worker builds its index lazily on the first suggestion request. When the
+catalog version moves, the next request reads only the books with an id above
+the highest one already indexed, so imports are picked up incrementally.
+Titles edited in place keep their old tokens until the worker restarts.
+"""
+import bisect
+import heapq
+import itertools
+import sys
+import threading
+from array import array
+
+from flask import current_app
+
+from models import db, Book
+from cache import catalog_version
+from search import tokenize
+
+SCAN_LIMIT = 2000
+TOP_PREFIX_LENGTH = 2
+# Fewer new tokens than this are inserted into a copy of the list; more are merged
+INSERT_LIMIT = 256
+
+
+class PrefixIndex:
+    """Sorted distinct tokens with usage counts"""
+
+    def __init__(self, limit=10):
+        self.limit = limit
+        self.max_id = 0
+        # (tokens, counts, top) swapped as one so readers never see a mix;
+        # top maps each short prefix to its most used tokens
+        self._state = ([], array('I'), {})
+
+    def add_books(self, rows):
+        """Index an iterable of (id, title, author) rows with ids above max_id"""
+        tokens, counts, _ = self._state
+        new, bumped = {}, set()
+        for book_id, title, author in rows:
+            self.max_id = max(self.max_id, book_id)
+            for token in set(tokenize(f'{title} {author}')):
+                i = bisect.bisect_left(tokens, token)
+                if i < len(tokens) and tokens[i] == token:
+                    counts[i] += 1
+                    bumped.add(tokens[i])
+                else:
+                    new[token] = new.get(token, 0) + 1
+        if new or bumped:
+            self._merge(new, bumped)
+
+    def _merge(self, new, bumped):
+        old_tokens, old_counts, old_top = self._state
+        added = [(sys.intern(t), c) for t, c in sorted(new.items())]
+        if not added:
+            tokens, counts = old_tokens, old_counts
+        elif len(added) < INSERT_LIMIT:
+            tokens, counts = old_tokens.copy(), array('I', old_counts)
+            for token, count in added:
+                i = bisect.bisect_left(tokens, token)
+                tokens.insert(i, token)
+                counts.insert(i, count)
+        else:
+            tokens, counts = [], array('I')
+            for token, count in heapq.merge(zip(old_tokens, old_counts), added):
+                tokens.append(token)
+                counts.append(count)
+
+        def count(token):
+            return counts[bisect.bisect_left(tokens, token)]
+
+        affected = {}
+        for token in itertools.chain(bumped, (t for t, _ in added)):
+            for n in range(1, min(TOP_PREFIX_LENGTH, len(token)) + 1):
+                affected.setdefault(token[:n], set()).add(token)
+        top = dict(old_top)
+        for prefix, changed in affected.items():
+            # Sorted first so ties keep token order, as a scan of the range would
+            candidates = sorted(changed.union(old_top.get(prefix, ())))
+            top[prefix] = tuple(heapq.nlargest(self.limit, candidates, key=count))
+        self._state = (tokens, counts, top)
+
+    def suggest(self, prefix, limit=None):
+        tokens, counts, top = self._state
+        limit = min(limit or self.limit, self.limit)
+        prefix = prefix.lower().strip()
+        if not prefix:
+            return []
+        if len(prefix) <= TOP_PREFIX_LENGTH:
+            return list(top.get(prefix, ())[:limit])
+        start = bisect.bisect_left(tokens, prefix)
+        end = start
+        stop = min(len(tokens), start + SCAN_LIMIT)
+        while end < stop and tokens[end].startswith(prefix):
+            end += 1
+        ids = heapq.nlargest(limit, range(start, end), key=counts.__getitem__)
+        return [tokens[i] for i in ids]
+
+    def __len__(self):
+        return len(self._state[0])
+
+
+class SuggestIndex:
+    """A worker's PrefixIndex, kept in step with the catalog"""
+
+    def __init__(self, limit=10, chunk_size=10000):
+        self.index = PrefixIndex(limit)
+        self.chunk_size = chunk_size
+        self.version = None
+        self._lock = threading.Lock()
+
+    def suggest(self, prefix, limit=None):
+        version = catalog_version()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self._catch_up()
+                    self.version = version
+        return self.index.suggest(prefix, limit)
+
+    def _catch_up(self):
+        rows = db.session.execute(
+            db.select(Book.id, Book.title, Book.author)
+            .where(Book.id > self.index.max_id)
+            .order_by(Book.id)
+            .execution_options(yield_per=self.chunk_size)
+        )
+        self.index.add_books(row for chunk in rows.partitions() for row in chunk)
+
+
+def get_suggest_index():
+    index = current_app.extensions.get('suggest')
+    if index is None:
+        index = current_app.extensions['suggest'] = SuggestIndex(
+            current_app.config.get('SUGGEST_LIMIT', 10))
+    return index
@@ -0,0 +1,50 @@
+"""
+Template compilation and per-row caching for books.html.
+
+With JINJA_BYTECODE_CACHE_DIR set, compiled templates are kept there, so a
+restarted server loads bytecode instead of parsing and compiling every
+template again. gunicorn.conf also compiles them in the master before it
+forks, so workers start with them in memory.
+
+Each row of books.html comes from the book_row macro. Its markup depends only
+on the book's columns and on whether the viewer has it on loan, so it is
+cached under exactly those values (CATALOG_ROW_CACHE_SIZE rows) and shared by
+every user; entries can't go stale, only fall out of the LRU. The one per-user
+detail that isn't in the key, a hold's queue position, is rendered fresh.
+"""
+import os
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+
+from cache import get_catalog_cache
+
+ROW_TEMPLATE = 'book_row.html'
+
+
+def _render_row(book, mine, position):
+    return current_app.jinja_env.get_template(ROW_TEMPLATE).module.book_row(book, mine, position)
+
+
+def book_row(book, mine, position=None):
+    """Markup for one catalog row; `position` is the viewer's place in the book's queue"""
+    if position is not None and not book.available and not mine:
+        return _render_row(book, mine, position)
+    key = (book.id, book.title, book.author, book.available, mine)
+    return get_catalog_cache().row(key, lambda: _render_row(book, mine, None))
+
+
+def warm_templates(app):
+    """Compile every template now (through the bytecode cache); returns how many"""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def init_templates(app):
+    directory = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    app.add_template_global(book_row)
@@ -0,0 +1,66 @@
+"""
+Creating accounts, from the register form or in bulk from a roster.
+
+Neither looks user_id or email up first. The INSERT relies on the unique
+constraints on both columns and, when it clashes, duplicate_field() reads
+the column back out of the IntegrityError. A new account therefore costs one
+statement, and two concurrent signups for the same email can't both succeed.
+
+Roster accounts can come without a password. They get an unusable one and
+can't be logged into; registering with their user ID or email is refused
+like any other duplicate, so nobody can claim them that way.
+"""
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User
+
+UNIQUE_FIELDS = ('user_id', 'email')
+
+
+class UserExists(Exception):
+    """The user ID or email is taken; field says which"""
+
+    def __init__(self, field):
+        super().__init__(field)
+        self.field = field
+
+
+def duplicate_field(error):
+    """
+    The column ('user_id' or 'email') whose unique constraint an IntegrityError
+    reports, or None for any other integrity failure. Understands SQLite
+    ("UNIQUE constraint failed: user.email"), MySQL ("Duplicate entry '...'
+    for key 'user.email'") and PostgreSQL ('... unique constraint
+    "user_email_key"').
+    """
+    message = str(getattr(error, 'orig', error)).lower()
+    if 'unique' not in message and 'duplicate' not in message:
+        return None
+    # Only look past the offending value (MySQL quotes it first) and before
+    # PostgreSQL's DETAIL line, which quotes it again
+    for marker in ('constraint failed:', 'for key', 'unique constraint'):
+        if marker in message:
+            message = message.rsplit(marker, 1)[1]
+            break
+    constraint = message.split('\n', 1)[0]
+    # user_id first: "user.email" contains no user_id, but "user_user_id_key" does
+    for field in UNIQUE_FIELDS:
+        if field in constraint:
+            return field
+    return None
+
+
+def create_user(user_id, name, email, password):
+    """
+    Add an account with an already hashed password; raises UserExists if the
+    user ID or email is taken.
+    """
+    db.session.add(User(user_id=user_id, name=name, email=email, password=password))
+    try:
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        field = duplicate_field(e)
+        if field is None:
+            raise
+        raise UserExists(field) from e
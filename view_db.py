@@ -1,78 +1,144 @@
 """
 Simple script to view the contents of library.db database
+
+Connections are opened read-only (SQLite URI mode=ro), so inspecting a live
+database never takes a write lock. Rows are fetched in chunks with fetchmany.
+--stream prints each chunk as it arrives; the default grid needs every row
+up front to size its columns, so without --limit it shows at most
+GRID_MAX_ROWS of them and says so when there are more.
 """
+import argparse
+import csv
+import json
 import sqlite3
+import sys
+from urllib.parse import quote
+
 from tabulate import tabulate
 
+DEFAULT_DB = 'instance/library.db'
+CHUNK_SIZE = 1000
+GRID_MAX_ROWS = 1000
+
+
+def connect(db_path=DEFAULT_DB, write=False):
+    """Open the database read-only unless write=True"""
+    mode = 'rw' if write else 'ro'
+    return sqlite3.connect(f'file:{quote(db_path)}?mode={mode}', uri=True)
+
+
+def iter_chunks(cursor, chunk_size=CHUNK_SIZE):
+    """Yield lists of rows from an executed cursor, chunk_size at a time"""
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def paged(query, limit=None, offset=0):
+    """Wrap a SELECT so only one page of it is read"""
+    if limit is None and not offset:
+        return query, ()
+    return (f'SELECT * FROM ({query.rstrip().rstrip(";")}) LIMIT ? OFFSET ?',
+            (-1 if limit is None else limit, offset))
+
+
+def print_rows(cursor, stream=False, chunk_size=CHUNK_SIZE, max_rows=GRID_MAX_ROWS):
+    """
+    Print the rows of an executed cursor; returns how many were printed. The
+    grid reads at most max_rows (None for all) and notes any it leaves out.
+    """
+    columns = [desc[0] for desc in cursor.description]
+    total = 0
+    if stream:
+        # Tab-separated, one chunk at a time as rows arrive; the csv writer
+        # quotes values holding tabs or newlines and prints NULL as empty
+        out = csv.writer(sys.stdout, delimiter='\t', lineterminator='\n')
+        out.writerow(columns)
+        for rows in iter_chunks(cursor, chunk_size):
+            out.writerows(['' if value is None else value for value in row] for row in rows)
+            total += len(rows)
+        return total
+
+    if max_rows is None:
+        rows = [row for chunk in iter_chunks(cursor, chunk_size) for row in chunk]
+        more = False
+    else:
+        rows = cursor.fetchmany(max_rows + 1)
+        more = len(rows) > max_rows
+        del rows[max_rows:]
+    if rows:
+        try:
+            print(tabulate(rows, headers=columns, tablefmt='grid'))
+        except ImportError:
+            print("Columns:", ", ".join(columns))
+            for row in rows:
+                print(row)
+    if more:
+        print("... more rows not shown; page with --limit/--offset or print all with --stream")
+    return len(rows)
+
+
+def _grid_rows(limit):
+    # An explicit --limit already bounds the page
+    return None if limit is not None else GRID_MAX_ROWS
+
+
+def view_database(db_path=DEFAULT_DB, limit=None, offset=0, stream=False, tables=None):
+    """Display all data from the library database, or only the named tables"""
 
-def view_database(db_path='instance/library.db'):
-    """Display all data from the library database"""
-    
     # Connect to database
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     cursor = conn.cursor()
-    
+
     print("=" * 80)
     print("LIBRARY DATABASE CONTENTS")
     print("=" * 80)
-    
+
     # Get all table names
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    
-    for table in tables:
-        table_name = table[0]
+    names = [row[0] for row in cursor.fetchall()]
+    if tables:
+        missing = set(tables) - set(names)
+        if missing:
+            print(f"No such table: {', '.join(sorted(missing))}")
+        names = [name for name in names if name in tables]
+
+    for table_name in names:
         print(f"\n{'=' * 80}")
         print(f"TABLE: {table_name}")
         print('=' * 80)
-        
-        # Get column names
-        cursor.execute(f"PRAGMA table_info({table_name})")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        # Get all data from table
-        cursor.execute(f"SELECT * FROM {table_name}")
-        rows = cursor.fetchall()
-        
-        if rows:
-            # Print as formatted table
-            try:
-                print(tabulate(rows, headers=columns, tablefmt='grid'))
-            except ImportError:
-                # If tabulate not installed, print simple format
-                print("Columns:", ", ".join(columns))
-                for row in rows:
-                    print(row)
-        else:
+
+        query, params = paged(f'SELECT * FROM "{table_name}"', limit, offset)
+        cursor.execute(query, params)
+        shown = print_rows(cursor, stream, max_rows=_grid_rows(limit))
+
+        if not shown:
             print("(Empty table)")
-        
-        print(f"\nTotal rows: {len(rows)}")
-    
+
+        print(f"\nRows shown: {shown}")
+
     conn.close()
     print("\n" + "=" * 80)
 
 
-def query_database(query, db_path='instance/library.db'):
+def query_database(query, db_path=DEFAULT_DB, limit=None, offset=0, stream=False, write=False):
     """Execute a custom SQL query"""
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path, write=write)
     cursor = conn.cursor()
-    
+
     try:
-        cursor.execute(query)
-        results = cursor.fetchall()
-        
+        is_select = query.lstrip().lower().startswith(('select', 'with'))
+        sql, params = paged(query, limit, offset) if is_select else (query, ())
+        cursor.execute(sql, params)
+
         # Get column names from cursor description
         if cursor.description:
-            columns = [desc[0] for desc in cursor.description]
             print("\nQuery Results:")
             print("=" * 80)
-            try:
-                print(tabulate(results, headers=columns, tablefmt='grid'))
-            except ImportError:
-                print("Columns:", ", ".join(columns))
-                for row in results:
-                    print(row)
-            print(f"\nRows returned: {len(results)}")
+            shown = print_rows(cursor, stream, max_rows=_grid_rows(limit))
+            print(f"\nRows returned: {shown}")
         else:
             print("Query executed successfully")
             conn.commit()
@@ -82,51 +148,127 @@ def query_database(query, db_path='instance/library.db'):
         conn.close()
 
 
-def show_schema(db_path='instance/library.db'):
+def show_schema(db_path=DEFAULT_DB):
     """Show the database schema (table structures)"""
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     cursor = conn.cursor()
-    
+
     print("=" * 80)
     print("DATABASE SCHEMA")
     print("=" * 80)
-    
+
     # Get all tables
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    
-    for table in tables:
-        table_name = table[0]
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table';")
+
+    for table_name, create_statement in cursor.fetchall():
         print(f"\nTable: {table_name}")
         print("-" * 80)
-        
-        # Get CREATE TABLE statement
-        cursor.execute(f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table_name}'")
-        create_statement = cursor.fetchone()[0]
         print(create_statement)
         print()
-    
+
     conn.close()
 
 
-if __name__ == "__main__":
-    import sys
-    
-    print("\n🔍 LIBRARY DATABASE VIEWER")
-    print("=" * 80)
-    
-    if len(sys.argv) > 1:
-        command = sys.argv[1]
-        
-        if command == "schema":
-            show_schema()
-        elif command == "query" and len(sys.argv) > 2:
-            query = sys.argv[2]
-            query_database(query)
+def export_rows(source, out_path, fmt, db_path=DEFAULT_DB, chunk_size=10000):
+    """
+    Export a table name or SELECT query to csv, jsonl or parquet, writing one
+    chunk at a time. Parquet needs pyarrow; each chunk becomes a row group.
+    """
+    conn = connect(db_path)
+    cursor = conn.cursor()
+    is_query = source.lstrip().lower().startswith(('select', 'with'))
+    cursor.execute(source if is_query else f'SELECT * FROM "{source}"')
+    columns = [desc[0] for desc in cursor.description]
+    total = 0
+
+    try:
+        if fmt == 'parquet':
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise SystemExit('Parquet export needs pyarrow: pip install pyarrow')
+            writer = None
+            for rows in iter_chunks(cursor, chunk_size):
+                table = pa.Table.from_pydict(
+                    {name: [row[i] for row in rows] for i, name in enumerate(columns)})
+                if writer is None:
+                    writer = pq.ParquetWriter(out_path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+                total += len(rows)
+            if writer is not None:
+                writer.close()
         else:
-            print("Usage:")
-            print("  python view_db.py          - View all data")
-            print("  python view_db.py schema   - View database schema")
-            print('  python view_db.py query "SELECT * FROM user"  - Run custom query')
+            with open(out_path, 'w', newline='', encoding='utf-8') as f:
+                if fmt == 'csv':
+                    out = csv.writer(f)
+                    out.writerow(columns)
+                    for rows in iter_chunks(cursor, chunk_size):
+                        out.writerows(rows)
+                        total += len(rows)
+                else:
+                    for rows in iter_chunks(cursor, chunk_size):
+                        f.writelines(json.dumps(dict(zip(columns, row)), default=str) + '\n'
+                                     for row in rows)
+                        total += len(rows)
+    finally:
+        conn.close()
+    print(f"Exported {total} rows to {out_path}")
+    return total
+
+
+def add_paging_arguments(parser, defaults=True):
+    """--limit/--offset/--stream; subcommands pass defaults=False so they don't reset earlier ones"""
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+
+    parser.add_argument('--limit', type=int, default=default(None),
+                        help='Show at most this many rows per table/query')
+    parser.add_argument('--offset', type=int, default=default(0),
+                        help='Skip this many rows first')
+    parser.add_argument('--stream', action='store_true', default=default(False),
+                        help='Print rows tab-separated as they are fetched')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Inspect the library database (read-only).')
+    parser.add_argument('--db', default=DEFAULT_DB, help=f'SQLite file (default: {DEFAULT_DB})')
+    add_paging_arguments(parser)
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('schema', help='View database schema')
+    table = commands.add_parser('table', help='View the rows of some tables')
+    table.add_argument('tables', nargs='+', metavar='name')
+    add_paging_arguments(table, defaults=False)
+    query = commands.add_parser('query', help='Run a custom query')
+    add_paging_arguments(query, defaults=False)
+    query.add_argument('sql')
+    query.add_argument('--write', action='store_true', help='Allow statements that modify data')
+    export = commands.add_parser('export', help='Export a table or query to a file')
+    export.add_argument('source', help='Table name or SELECT statement')
+    export.add_argument('out', help='Output file')
+    export.add_argument('--format', choices=['csv', 'jsonl', 'parquet'], default='csv')
+    export.add_argument('--chunk-size', type=int, default=10000)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.command != 'export':
+        print("\n🔍 LIBRARY DATABASE VIEWER")
+        print("=" * 80)
+
+    if args.command == "schema":
+        show_schema(args.db)
+    elif args.command == "query":
+        query_database(args.sql, args.db, args.limit, args.offset, args.stream, args.write)
+    elif args.command == "export":
+        export_rows(args.source, args.out, args.format, args.db, args.chunk_size)
+    elif args.command == "table":
+        view_database(args.db, args.limit, args.offset, args.stream, args.tables)
     else:
-        view_database()
+        view_database(args.db, args.limit, args.offset, args.stream)
+
+
+if __name__ == "__main__":
+    main()